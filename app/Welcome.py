@@ -1,17 +1,31 @@
 import streamlit as st
 from es import init_es
+from rag import reset_vector_index
 from postgres import init_postgres
+from relevance_worker import start_workers
+from resources import warm_up
+import os
 
 def main():
 
+    # Load the model and create the clients in the background so that the first query is not slowed down
+    if "warm_up_done" not in st.session_state:
+        if os.getenv("WARM_UP", "true").lower() == "true":
+            warm_up(background=True)
+        st.session_state.warm_up_done = True
+
      # Elastic Search initialization not done yet
     if "init_es_done" not in st.session_state or not st.session_state.init_es_done:
-        init_es()
+        if init_es():
+            # The in-process vector index was built from the old index
+            reset_vector_index()
         st.session_state.init_es_done = True
 
     # Postgres initialization not done yet
     if "init_postgres_done" not in st.session_state or not st.session_state.init_postgres_done:
         init_postgres()
+        # Judge the dialogs left pending when the application stopped
+        start_workers()
         st.session_state.init_postgres_done = True   
 
     # Set browser tab title
@@ -0,0 +1,393 @@
+import asyncio
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Literal
+import psycopg2
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+import rag
+from rag import (encode_query, truncate_vectors, retrieval_bodies, retrieval_fuse, retrieve, build_prompt, calculate_cost,
+                 cached_response, coalesced_response, build_response, parse_relevance, RELEVANCE_PROMPT_TEMPLATE,
+                 PENDING_RELEVANCE, NOT_EVALUATED_RELEVANCE, REQUEST_COALESCING_ENABLED, index_name)
+from semantic_cache import answer_cache, SEMANTIC_CACHE_ENABLED
+from batch_encoder import batch_encoder, BATCH_ENCODER_ENABLED
+from embedding_store import get_embedding_store, EMBEDDING_CACHE_ENABLED
+from postgres import init_postgres, insert_dialog, insert_feedback, dialog_exists, pool_stats
+from relevance_worker import schedule_relevance, start_workers
+from resources import warm_up
+from tracing import Trace
+from single_flight import AsyncSingleFlight, coalesce_key
+
+# Load environment variables
+load_dotenv()
+
+# HTTP API of the assistant for the storefront widget.
+# Ask, stream an answer and submit feedback. The pipeline is the one of rag.py,
+# with the Open AI and Elastic Search calls made by async clients so that one
+# process serves many concurrent requests. Encoding and the database writes
+# run in threads. Streamlit stays the admin and evaluation UI.
+
+# Open AI model of the answers
+API_OPENAI_MODEL = os.getenv("API_OPENAI_MODEL", rag.OPENAI_MODEL)
+# Maximum number of requests answered at the same time
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", 100))
+# Seconds a request waits for a free slot before it is rejected with 503
+API_QUEUE_TIMEOUT = float(os.getenv("API_QUEUE_TIMEOUT", 5))
+# Seconds a request may take before it is cancelled with 504
+API_REQUEST_TIMEOUT = float(os.getenv("API_REQUEST_TIMEOUT", 60))
+
+# Identical questions asked at the same time share one answer
+in_flight = AsyncSingleFlight()
+
+# Async clients, created when the application starts
+clients = {}
+
+# Limits the requests answered at the same time.
+# Created when the application starts, in the event loop of the server.
+request_slots = None
+
+# This function checks the version of the index behind the alias periodically.
+# When the index was rebuilt or synced the cached answers and the in-process
+# vector index, which were built from the old index, are dropped (see rag.check_index_version).
+async def watch_index_version():
+    while True:
+        try:
+            await asyncio.to_thread(rag.check_index_version)
+        except Exception as e:
+            print(f"Index version check failed: {e}")
+        await asyncio.sleep(rag.INDEX_VERSION_CHECK_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app):
+    global request_slots
+
+    request_slots = asyncio.Semaphore(API_MAX_CONCURRENCY)
+
+    from openai import AsyncOpenAI
+    from elasticsearch import AsyncElasticsearch
+
+    clients["openai"] = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=API_REQUEST_TIMEOUT)
+    clients["es"] = AsyncElasticsearch(os.getenv("ELASTIC_URL"), request_timeout=API_REQUEST_TIMEOUT)
+
+    # Load the model and create the tables before the first request
+    await asyncio.to_thread(warm_up, False)
+    await asyncio.to_thread(init_postgres)
+
+    # Judge the dialogs left pending when the application stopped
+    start_workers()
+
+    watcher = asyncio.create_task(watch_index_version())
+
+    yield
+
+    watcher.cancel()
+
+    await clients["es"].close()
+    await clients["openai"].close()
+
+app = FastAPI(title="eCommerce site assistant", lifespan=lifespan)
+
+class AskRequest(BaseModel):
+    question: str = Field(min_length=1, max_length=2000)
+
+class FeedbackRequest(BaseModel):
+    dialog_id: str
+    feedback: Literal[1, -1]
+
+# This function takes a request slot, or rejects the request when none is free in time
+async def acquire_slot():
+    try:
+        await asyncio.wait_for(request_slots.acquire(), API_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Too many requests, try again later")
+
+# This context manager holds a request slot while a request is answered
+@asynccontextmanager
+async def request_slot():
+
+    await acquire_slot()
+
+    try:
+        yield
+    finally:
+        request_slots.release()
+
+# This function encodes a query to a vector.
+# The batch encoder future is awaited, so waiting queries do not hold a thread.
+async def encode(query):
+
+    if BATCH_ENCODER_ENABLED:
+        return truncate_vectors(await asyncio.wrap_future(batch_encoder.submit(query)), rag.INDEX_PROFILE["dims"])
+
+    return await asyncio.to_thread(encode_query, query)
+
+# This function retrieves the documents of a query.
+# Elastic Search requests are sent with one _msearch round trip.
+async def search(query, query_v):
+
+    if rag.RETRIEVAL_BACKEND == "numpy":
+        return await asyncio.to_thread(retrieve, query, query_v)
+
+    searches = []
+    for body in retrieval_bodies(query, query_v):
+        searches.append({"index": index_name})
+        searches.append(body)
+
+    response = await clients["es"].msearch(searches=searches)
+
+    return retrieval_fuse([[hit['_source'] for hit in item.get('hits', {}).get('hits', [])] for item in response['responses']])
+
+# Define async llm function
+async def llm(prompt, model):
+
+    # Get start time
+    start_time = time.time()
+
+    response = await clients["openai"].chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}]
+    )
+
+    # Calculate response time
+    response_time = time.time() - start_time
+
+    # LLM tokens
+    tokens = {
+        'prompt_tokens': response.usage.prompt_tokens,
+        'completion_tokens': response.usage.completion_tokens,
+        'total_tokens': response.usage.total_tokens
+    }
+
+    return response.choices[0].message.content, tokens, response_time, calculate_cost(tokens['prompt_tokens'], tokens['completion_tokens'])
+
+# This function judges the relevance of an answer according to the relevance mode
+async def judge_relevance(query, answer):
+
+    if rag.RELEVANCE_MODE == "deferred":
+        return rag.judge_relevance(query, answer, "deferred")
+
+    eval, tokens, _, cost = await llm(RELEVANCE_PROMPT_TEMPLATE.format(question=query, answer=answer), rag.OPENAI_MODEL)
+
+    return parse_relevance(eval), tokens, cost
+
+# This function runs the steps before the answer: encoding, the answer cache and search.
+# Returns the query vector, the cached response or None and the prompt.
+async def prepare(query, model, trace, start_time):
+
+    # Encode query to a vector
+    with trace.span("encode"):
+        query_v = await encode(query)
+
+    # Return the cached answer of a similar question if there is one
+    if SEMANTIC_CACHE_ENABLED:
+        with trace.span("cache_lookup"):
+            cached = answer_cache.lookup(model, query_v)
+        if cached is not None:
+            return query_v, cached_response(cached, start_time, trace), None, None
+
+    # Get results from elastic database
+    with trace.span("search"):
+        search_results = await search(query, query_v)
+
+    # Build a prompt within the context token budget
+    with trace.span("build_prompt"):
+        prompt, context = build_prompt(query, search_results, model=model)
+
+    return query_v, None, prompt, context
+
+# This function stores the dialog and queues it for relevance judging
+async def store_dialog(dialog_id, query, response):
+    await asyncio.to_thread(insert_dialog, dialog_id, query, response)
+    schedule_relevance(dialog_id, query, response)
+
+# Define async rag function
+async def answer_question(query, model):
+
+    # Get start time
+    start_time = time.time()
+
+    # Time every stage of the request
+    trace = Trace()
+
+    query_v, response, prompt, context = await prepare(query, model, trace, start_time)
+    if response is not None:
+        return response
+
+    # Get answer from LLM
+    with trace.span("llm"):
+        answer, tokens, response_time, cost = await llm(prompt, model)
+
+    # Get relevance from LLM
+    with trace.span("relevance"):
+        relevance, eval_tokens, eval_total_cost = await judge_relevance(query, answer)
+
+    # Without streaming the first token arrives with the whole answer
+    response = build_response(answer, tokens, response_time, response_time, cost, relevance, eval_tokens, eval_total_cost, context, trace)
+
+    # Cache the answer for similar questions
+    if SEMANTIC_CACHE_ENABLED:
+        answer_cache.store(model, query_v, response)
+
+    return response
+
+# This function returns the public part of a response
+def answer_body(dialog_id, response):
+    return {
+        'id': dialog_id,
+        'answer': response['answer'],
+        'relevance': response['relevance'] if response['relevance'] != PENDING_RELEVANCE else NOT_EVALUATED_RELEVANCE,
+        'response_time': response['response_time'],
+        'cache_hit': bool(response['cache_hit']),
+        'coalesced': bool(response['coalesced'])
+    }
+
+@app.get("/health")
+async def health():
+    return {'status': 'ok'}
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        'batch_encoder': batch_encoder.stats(),
+        'answer_cache': answer_cache.stats(),
+        'embedding_store': get_embedding_store().stats() if EMBEDDING_CACHE_ENABLED else None,
+        'coalescing': in_flight.stats(),
+        'postgres_pool': pool_stats()
+    }
+
+@app.post("/ask")
+async def ask(request: AskRequest):
+
+    async with request_slot():
+
+        start_time = time.time()
+
+        try:
+            if REQUEST_COALESCING_ENABLED:
+                response, coalesced = await asyncio.wait_for(in_flight.do(coalesce_key(request.question, API_OPENAI_MODEL, SEMANTIC_CACHE_ENABLED, rag.RELEVANCE_MODE),
+                                                                          answer_question(request.question, API_OPENAI_MODEL)),
+                                                             API_REQUEST_TIMEOUT)
+                if coalesced:
+                    response = coalesced_response(response, start_time)
+            else:
+                response = await asyncio.wait_for(answer_question(request.question, API_OPENAI_MODEL), API_REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="The answer took too long")
+
+        dialog_id = str(uuid.uuid4())
+        await store_dialog(dialog_id, request.question, response)
+
+    return answer_body(dialog_id, response)
+
+# Streaming response which holds a request slot until it is sent.
+# The slot is released when the response ends, fails or is cancelled,
+# also when the client disconnects before the stream started.
+class SlotStreamingResponse(StreamingResponse):
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            request_slots.release()
+
+# The answer is streamed as plain text. The dialog id, which the feedback refers to,
+# is sent in the X-Dialog-Id header and the dialog is stored when the stream ends.
+@app.post("/ask/stream")
+async def ask_stream(request: AskRequest):
+
+    # The slot is released by the response, not when this function returns
+    await acquire_slot()
+
+    query = request.question
+    model = API_OPENAI_MODEL
+    dialog_id = str(uuid.uuid4())
+    start_time = time.time()
+    trace = Trace()
+
+    try:
+        query_v, cached, prompt, context = await asyncio.wait_for(prepare(query, model, trace, start_time), API_REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        request_slots.release()
+        raise HTTPException(status_code=504, detail="The answer took too long")
+    except BaseException:
+        request_slots.release()
+        raise
+
+    async def stream():
+
+        if cached is not None:
+            yield cached['answer']
+            await store_dialog(dialog_id, query, cached)
+            return
+
+        # Stream answer from LLM. The last chunk contains the token usage.
+        llm_start = time.time()
+        first_token_time = None
+        parts = []
+        usage = None
+
+        response_stream = await clients["openai"].chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+        async for chunk in response_stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                # Time to first token
+                if first_token_time is None:
+                    first_token_time = time.time() - llm_start
+                parts.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if time.time() - start_time > API_REQUEST_TIMEOUT:
+                raise asyncio.TimeoutError("The answer took too long")
+
+        response_time = time.time() - llm_start
+        trace.add("llm", llm_start, response_time)
+
+        # LLM tokens
+        tokens = {
+            'prompt_tokens': usage.prompt_tokens if usage else 0,
+            'completion_tokens': usage.completion_tokens if usage else 0,
+            'total_tokens': usage.total_tokens if usage else 0
+        }
+        answer = "".join(parts)
+
+        # Get relevance from LLM
+        with trace.span("relevance"):
+            relevance, eval_tokens, eval_total_cost = await judge_relevance(query, answer)
+
+        response = build_response(answer, tokens, response_time, first_token_time or response_time,
+                                  calculate_cost(tokens['prompt_tokens'], tokens['completion_tokens']),
+                                  relevance, eval_tokens, eval_total_cost, context, trace)
+
+        # Cache the answer for similar questions
+        if SEMANTIC_CACHE_ENABLED:
+            answer_cache.store(model, query_v, dict(response))
+
+        await store_dialog(dialog_id, query, response)
+
+    return SlotStreamingResponse(stream(), media_type="text/plain", headers={"X-Dialog-Id": dialog_id})
+
+@app.post("/feedback")
+async def feedback(request: FeedbackRequest):
+
+    async with request_slot():
+
+        # In write-behind mode an unknown dialog would only fail in the writer
+        if not await asyncio.to_thread(dialog_exists, request.dialog_id):
+            raise HTTPException(status_code=404, detail="Unknown dialog")
+
+        try:
+            await asyncio.to_thread(insert_feedback, request.dialog_id, request.feedback)
+        except psycopg2.IntegrityError:
+            raise HTTPException(status_code=404, detail="Unknown dialog")
+
+    return {'status': 'ok'}
@@ -0,0 +1,124 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dotenv import load_dotenv
+from embedding_store import encode
+
+# Load environment variables
+load_dotenv()
+
+# Micro-batching encoder.
+# Queries encoded at the same time by concurrent requests are collected by a
+# background thread for at most max_wait seconds (or until max_batch_size
+# queries are waiting) and encoded with one batch call. Each caller gets its
+# vector through a future.
+class BatchEncoder:
+
+    def __init__(self, encode_batch, max_batch_size=32, max_wait=0.005):
+        # Function which encodes a list of texts to a matrix
+        self.encode_batch = encode_batch
+        # Maximum number of texts encoded at once
+        self.max_batch_size = max_batch_size
+        # Maximum seconds the first text of a batch waits for more texts
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        # Counters
+        self.batches = 0
+        self.encoded = 0
+        self.largest_batch = 0
+        self.last_batch_size = 0
+
+    # This function queues a text and returns the future of its vector
+    def submit(self, text):
+
+        self.start()
+
+        future = Future()
+        self.queue.put((text, future))
+
+        return future
+
+    # This function encodes a text, batched with the texts of other threads
+    def encode(self, text):
+        return self.submit(text).result()
+
+    # This function starts the background thread on first use
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="batch-encoder", daemon=True)
+                self.thread.start()
+
+    # This function takes the next batch from the queue.
+    # It waits for the first text and then up to max_wait seconds for more.
+    def next_batch(self):
+
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    # Background loop: encode a batch and hand every caller its vector.
+    # Texts whose caller cancelled the future (eg after a timeout) are skipped,
+    # and no error of a batch ends the loop.
+    def run(self):
+        while True:
+
+            # A running future can no longer be cancelled
+            batch = [(text, future) for text, future in self.next_batch() if future.set_running_or_notify_cancel()]
+
+            if not batch:
+                continue
+
+            try:
+                self.encode_futures(batch)
+            except Exception as e:
+                print(f"Batch encoder failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    # This function encodes a batch and sets the vector of every future
+    def encode_futures(self, batch):
+
+        vectors = self.encode_batch([text for text, _ in batch])
+
+        for (_, future), vector in zip(batch, vectors):
+            future.set_result(vector)
+
+        with self.lock:
+            self.batches += 1
+            self.encoded += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.last_batch_size = len(batch)
+
+    # This function returns the encoder metrics
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'batches': self.batches,
+                'encoded': self.encoded,
+                'mean_batch_size': self.encoded / self.batches if self.batches else 0.0,
+                'last_batch_size': self.last_batch_size,
+                'largest_batch': self.largest_batch
+            }
+
+# Micro-batching settings
+BATCH_ENCODER_ENABLED = os.getenv("BATCH_ENCODER_ENABLED", "true").lower() == "true"
+
+# Query encoder shared by all requests of the process
+batch_encoder = BatchEncoder(lambda texts: encode(texts, batch_size=len(texts)),
+                             max_batch_size=int(os.getenv("BATCH_ENCODER_MAX_BATCH_SIZE", 32)),
+                             max_wait=float(os.getenv("BATCH_ENCODER_MAX_WAIT", 0.005)))
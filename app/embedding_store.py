@@ -0,0 +1,226 @@
+import numpy as np
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from dotenv import load_dotenv
+from resources import get_encoder
+from encoder_backend import encoder_id
+
+# Load environment variables
+load_dotenv()
+
+# Persistent embedding store.
+# Embeddings are content-addressed by the hash of the model name and the text.
+# Vectors are kept in a memory-mapped float32 file with one row per text and
+# an index file which maps each key to its row and last use time.
+# When the store is full the least recently used embeddings are evicted.
+# The store is emptied when the sentence transformer model or its backend changes.
+class EmbeddingStore:
+
+    def __init__(self, path, model_name, max_entries=100000, save_interval=30):
+        self.path = path
+        self.model_name = model_name
+        # Maximum number of embeddings kept
+        self.max_entries = max_entries
+        # Seconds between index file writes
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.dims = None
+        # key -> [row, last used time]
+        self.index = {}
+        self.free_rows = []
+        self.dirty = False
+        self.last_save = time.time()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    # This function returns the key of a text
+    def key(self, text):
+        return hashlib.sha1(f"{self.model_name}\x1f{text}".encode("utf-8")).hexdigest()
+
+    # This function loads the store, or empties it when it was created with another model.
+    # A missing, unreadable or inconsistent store (for example after a crash) is emptied too.
+    def load(self):
+
+        meta_path = os.path.join(self.path, "meta.json")
+
+        if not os.path.exists(meta_path):
+            return
+
+        try:
+            with open(meta_path, "r") as meta_file:
+                meta = json.load(meta_file)
+
+            if meta["model"] != self.model_name or meta["capacity"] != self.max_entries:
+                # Embeddings of another model (or store size) are not reused
+                raise ValueError("The store was created with other settings")
+
+            with open(os.path.join(self.path, "index.json"), "r") as index_file:
+                index = json.load(index_file)
+
+            rows = [row for row, _ in index.values()]
+            if len(set(rows)) != len(rows) or any(not 0 <= row < self.max_entries for row in rows):
+                raise ValueError("The index file is inconsistent")
+
+            vectors = np.memmap(os.path.join(self.path, "vectors.f32"), dtype=np.float32, mode="r+", shape=(self.max_entries, meta["dims"]))
+
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Embedding store emptied: {e}")
+            shutil.rmtree(self.path, ignore_errors=True)
+            return
+
+        self.index = index
+        self.dims = meta["dims"]
+        self.vectors = vectors
+        used_rows = set(rows)
+        self.free_rows = [row for row in range(self.max_entries - 1, -1, -1) if row not in used_rows]
+
+    # This function creates the vectors file on first use.
+    # An empty index file is written with it, so the store is complete from the start.
+    def create(self, dims):
+
+        os.makedirs(self.path, exist_ok=True)
+
+        self.dims = dims
+        self.vectors = np.memmap(os.path.join(self.path, "vectors.f32"), dtype=np.float32, mode="w+", shape=(self.max_entries, dims))
+        self.free_rows = list(range(self.max_entries - 1, -1, -1))
+
+        self.dirty = True
+        self.save()
+
+        with open(os.path.join(self.path, "meta.json"), "w") as meta_file:
+            json.dump({"model": self.model_name, "dims": dims, "capacity": self.max_entries}, meta_file)
+
+    # This function evicts the least recently used tenth of the embeddings.
+    # The index without them is written before their rows are reused, so the
+    # index file never maps a key to a row which holds another embedding.
+    def evict(self):
+
+        count = max(1, self.max_entries // 10)
+        rows = [self.index.pop(key)[0] for key in sorted(self.index, key=lambda k: self.index[k][1])[:count]]
+
+        self.dirty = True
+        self.save()
+
+        self.free_rows.extend(rows)
+
+    # This function writes the index file. Must be called with the lock held.
+    def save(self):
+
+        if not self.dirty or self.vectors is None:
+            return
+
+        self.vectors.flush()
+
+        # Write to a temporary file first so that a crash never leaves a broken index
+        temp_path = os.path.join(self.path, "index.json.tmp")
+        with open(temp_path, "w") as index_file:
+            json.dump(self.index, index_file)
+        os.replace(temp_path, os.path.join(self.path, "index.json"))
+
+        self.dirty = False
+        self.last_save = time.time()
+
+    # This function writes the index file
+    def flush(self):
+        with self.lock:
+            self.save()
+
+    # This function encodes texts, using stored embeddings where possible.
+    # Only texts which are not in the store are encoded.
+    def encode(self, texts, model, batch_size=64):
+
+        keys = [self.key(text) for text in texts]
+        now = time.time()
+        result = [None] * len(texts)
+        missing = {}
+
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.index:
+                    self.index[key][1] = now
+                    result[i] = np.array(self.vectors[self.index[key][0]])
+                else:
+                    missing.setdefault(key, []).append(i)
+            self.hits += len(texts) - sum(len(positions) for positions in missing.values())
+            self.misses += sum(len(positions) for positions in missing.values())
+
+        if missing:
+
+            # Encode the missing texts in batches, each distinct text once
+            missing_keys = list(missing)
+            vectors = np.asarray(model.encode([texts[missing[key][0]] for key in missing_keys], batch_size=batch_size), dtype=np.float32)
+
+            with self.lock:
+
+                if self.vectors is None:
+                    self.create(vectors.shape[1])
+
+                for key, vector in zip(missing_keys, vectors):
+                    for i in missing[key]:
+                        result[i] = vector
+                    if key in self.index:
+                        continue
+                    if not self.free_rows:
+                        self.evict()
+                    row = self.free_rows.pop()
+                    self.vectors[row] = vector
+                    self.index[key] = [row, now]
+
+                self.dirty = True
+                if time.time() - self.last_save > self.save_interval:
+                    self.save()
+
+        return np.stack(result) if result else np.zeros((0, self.dims or 0), dtype=np.float32)
+
+    # This function returns the store counters
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.index),
+                'max_entries': self.max_entries
+            }
+
+# Store settings
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+
+# Store shared by the whole process, created on first use
+store = None
+store_lock = threading.Lock()
+
+# This function returns the embedding store
+def get_embedding_store():
+    global store
+
+    with store_lock:
+        if store is None:
+            store = EmbeddingStore(path=os.getenv("EMBEDDING_CACHE_PATH", "./data/embedding_cache"),
+                                   model_name=encoder_id(),
+                                   max_entries=int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 100000)))
+            # Write the index file before the process exits
+            atexit.register(store.flush)
+
+    return store
+
+# This function encodes a text or a list of texts like SentenceTransformer.encode,
+# consulting the embedding store before the model
+def encode(texts, batch_size=64, model=None):
+
+    model = model or get_encoder()
+
+    if not EMBEDDING_CACHE_ENABLED:
+        return model.encode(texts, batch_size=batch_size)
+
+    if isinstance(texts, str):
+        return get_embedding_store().encode([texts], model, batch_size=batch_size)[0]
+
+    return get_embedding_store().encode(list(texts), model, batch_size=batch_size)
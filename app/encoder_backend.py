@@ -0,0 +1,157 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Sentence transformer backends.
+# "torch" runs the model in PyTorch fp32. "onnx" and "openvino" export the model
+# once to an optimized CPU runtime, optionally with int8 dynamic quantization (onnx).
+# An exported model is checked against the torch model on sample texts from the
+# data file and only used if every embedding is within the cosine tolerance.
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "torch")
+# "none" or "int8" (dynamic quantization, onnx backend only)
+ENCODER_QUANTIZATION = os.getenv("ENCODER_QUANTIZATION", "none")
+# Instruction set the int8 model is quantized for: arm64, avx2, avx512 or avx512_vnni
+ENCODER_QUANTIZATION_CONFIG = os.getenv("ENCODER_QUANTIZATION_CONFIG", "avx512_vnni")
+# Number of CPU threads of the encoder (default: the runtime's default)
+ENCODER_THREADS = int(os.getenv("ENCODER_THREADS", 0))
+# Folder of the exported models
+ENCODER_EXPORT_PATH = os.getenv("ENCODER_EXPORT_PATH", "./data/encoder")
+# Minimum cosine similarity between the embeddings of an exported model and the torch model
+ENCODER_COSINE_TOLERANCE = float(os.getenv("ENCODER_COSINE_TOLERANCE", 0.99))
+
+# This function returns the folder of an exported model
+def export_path(model_name, backend, quantization):
+    return os.path.join(ENCODER_EXPORT_PATH, f"{model_name}-{backend}-{quantization}".replace("/", "_"))
+
+# This function returns the validation result of an exported model, or None if it is not exported yet
+def load_validation(path):
+
+    validation_path = os.path.join(path, "validation.json")
+
+    if not os.path.exists(validation_path):
+        return None
+
+    with open(validation_path, "r") as validation_file:
+        return json.load(validation_file)
+
+# This function returns the id of an encoder configuration.
+# Embeddings of different configurations differ slightly, so the embedding
+# store and the index content hashes are keyed by it.
+def encoder_id(model_name=None, backend=None, quantization=None):
+
+    model_name = model_name or os.getenv("SENTENCE_TRANSFORMER_MODEL")
+    backend = backend or ENCODER_BACKEND
+    quantization = quantization or ENCODER_QUANTIZATION
+
+    if backend == "torch":
+        return model_name
+
+    # A model which failed validation is replaced by the torch model
+    validation = load_validation(export_path(model_name, backend, quantization))
+    if validation is not None and not validation["valid"]:
+        return model_name
+
+    return f"{model_name}:{backend}:{quantization}"
+
+# This function returns sample texts of the data file, used to validate exported models
+def sample_texts(path="./data/data.csv", size=200):
+    df = pd.read_csv(path)
+    texts = df['question'].tolist() + df['answer'].tolist()
+    return texts[:size // 2] + texts[len(df):len(df) + size // 2]
+
+# This function returns the cosine similarity of every pair of embeddings of two models
+def cosine_similarities(reference, candidate, texts):
+    a = np.asarray(reference.encode(texts, normalize_embeddings=True))
+    b = np.asarray(candidate.encode(texts, normalize_embeddings=True))
+    return np.einsum("ij,ij->i", a, b)
+
+# This function returns the model keyword arguments of a backend
+def model_kwargs(backend, quantization, threads):
+
+    kwargs = {}
+
+    if backend == "onnx":
+        if quantization == "int8":
+            kwargs["file_name"] = f"onnx/model_qint8_{ENCODER_QUANTIZATION_CONFIG}.onnx"
+        if threads:
+            import onnxruntime
+            session_options = onnxruntime.SessionOptions()
+            session_options.intra_op_num_threads = threads
+            kwargs["session_options"] = session_options
+        kwargs["provider"] = "CPUExecutionProvider"
+
+    if backend == "openvino" and threads:
+        kwargs["ov_config"] = {"INFERENCE_NUM_THREADS": str(threads)}
+
+    return kwargs
+
+# This function exports a model to a backend and validates it against the torch model.
+# Returns the validation result, which is saved next to the exported model.
+def export_encoder(model_name, backend, quantization, path, reference=None):
+
+    from sentence_transformers import SentenceTransformer
+
+    if quantization == "int8" and backend != "onnx":
+        raise ValueError("int8 quantization is only supported with the onnx backend")
+
+    print(f"Exporting {model_name} to {backend}...")
+    model = SentenceTransformer(model_name, backend=backend)
+    model.save_pretrained(path)
+
+    if quantization == "int8":
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+        export_dynamic_quantized_onnx_model(model, ENCODER_QUANTIZATION_CONFIG, path)
+
+    # Compare the exported model with the torch model
+    reference = reference or SentenceTransformer(model_name)
+    exported = SentenceTransformer(path, backend=backend, model_kwargs=model_kwargs(backend, quantization, 0))
+    similarities = cosine_similarities(reference, exported, sample_texts())
+
+    validation = {
+        "model": model_name,
+        "backend": backend,
+        "quantization": quantization,
+        "min_cosine": float(similarities.min()),
+        "mean_cosine": float(similarities.mean()),
+        "tolerance": ENCODER_COSINE_TOLERANCE,
+        "valid": bool(similarities.min() >= ENCODER_COSINE_TOLERANCE)
+    }
+
+    with open(os.path.join(path, "validation.json"), "w") as validation_file:
+        json.dump(validation, validation_file, indent=2)
+
+    print(f"Validation: min cosine {validation['min_cosine']:.5f}, mean cosine {validation['mean_cosine']:.5f}")
+
+    return validation
+
+# This function loads the sentence transformer model with the given backend.
+# The model is exported on first use. A model which is not within the cosine
+# tolerance of the torch model is not used and the torch model is loaded instead.
+def load_encoder(model_name=None, backend=None, quantization=None, threads=None):
+
+    from sentence_transformers import SentenceTransformer
+
+    model_name = model_name or os.getenv("SENTENCE_TRANSFORMER_MODEL")
+    backend = backend or ENCODER_BACKEND
+    quantization = quantization or ENCODER_QUANTIZATION
+    threads = ENCODER_THREADS if threads is None else threads
+
+    if backend == "torch":
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        return SentenceTransformer(model_name)
+
+    path = export_path(model_name, backend, quantization)
+    validation = load_validation(path) or export_encoder(model_name, backend, quantization, path)
+
+    if not validation["valid"]:
+        print(f"The {backend} model is not within the cosine tolerance ({validation['min_cosine']:.5f} < {validation['tolerance']}), using torch.")
+        return load_encoder(model_name, "torch", "none", threads)
+
+    return SentenceTransformer(path, backend=backend, model_kwargs=model_kwargs(backend, quantization, threads))
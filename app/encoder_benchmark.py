@@ -0,0 +1,96 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from encoder_backend import load_encoder, cosine_similarities, sample_texts, ENCODER_COSINE_TOLERANCE, ENCODER_THREADS
+
+# Encoder backend benchmark.
+# Every backend configuration is compared with the torch model: the cosine
+# similarity of the embeddings, the latency of single query encodes and the
+# throughput of batch encodes of the data file texts.
+
+# Backend configurations: name -> (backend, quantization)
+CONFIGURATIONS = {
+    "torch": ("torch", "none"),
+    "onnx": ("onnx", "none"),
+    "onnx-int8": ("onnx", "int8"),
+    "openvino": ("openvino", "none")
+}
+
+# This function measures a model. Returns the latency percentiles of single
+# encodes in milliseconds and the batch throughput in texts per second.
+def measure(model, texts, queries, batch_size, warm_up=10):
+
+    # Warm up before measuring
+    for query in queries[:warm_up]:
+        model.encode(query)
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        model.encode(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    model.encode(texts, batch_size=batch_size)
+    throughput = len(texts) / (time.perf_counter() - start)
+
+    return {
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'texts_per_s': throughput
+    }
+
+# This function benchmarks the configurations against the torch model
+def run_benchmark(configurations, threads, batch_size, sample_size, queries):
+
+    texts = sample_texts(size=sample_size)
+    queries = texts[:queries]
+
+    reference = load_encoder(backend="torch", quantization="none", threads=threads)
+
+    rows = []
+
+    for name in configurations:
+
+        backend, quantization = CONFIGURATIONS[name]
+        print(f"Benchmarking {name}...")
+
+        model = reference if backend == "torch" else load_encoder(backend=backend, quantization=quantization, threads=threads)
+        similarities = cosine_similarities(reference, model, texts)
+
+        row = {'backend': name, 'min_cosine': float(similarities.min()), 'mean_cosine': float(similarities.mean())}
+        row.update(measure(model, texts, queries, batch_size))
+        rows.append(row)
+
+    df = pd.DataFrame(rows)
+    df['valid'] = df['min_cosine'] >= ENCODER_COSINE_TOLERANCE
+
+    # Speedup against the torch model
+    torch_row = df[df['backend'] == "torch"]
+    if not torch_row.empty:
+        df['latency_speedup'] = torch_row['p50_ms'].iloc[0] / df['p50_ms']
+        df['throughput_speedup'] = df['texts_per_s'] / torch_row['texts_per_s'].iloc[0]
+
+    return df
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Encoder backends: embedding accuracy, latency and throughput against torch")
+    parser.add_argument("--backends", nargs="+", choices=list(CONFIGURATIONS), default=list(CONFIGURATIONS))
+    parser.add_argument("--threads", type=int, default=ENCODER_THREADS, help="CPU threads of the encoders (default: the runtime's default)")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--sample", type=int, default=200, help="Number of data file texts to encode")
+    parser.add_argument("--queries", type=int, default=100, help="Number of single query encodes to time")
+    parser.add_argument("--output", default="./data/encoder-benchmark.csv", help="CSV file for the results table")
+    args = parser.parse_args()
+
+    backends = args.backends if "torch" in args.backends else ["torch"] + args.backends
+    df = run_benchmark(backends, args.threads, args.batch_size, args.sample, args.queries)
+    df.to_csv(args.output, index=False)
+
+    print(df.to_string(index=False, float_format=lambda x: f"{x:.4f}"))
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,99 +1,475 @@
 import pandas as pd
-from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
+import numpy as np
+from elasticsearch.helpers import parallel_bulk, scan
 from tqdm.auto import tqdm
+from vector_index import delete_saved_index, normalize, VECTOR_FIELDS
+from semantic_cache import answer_cache
+from resources import get_encoder, get_es_client
+from embedding_store import encode
+from encoder_backend import encoder_id
 import os
+import time
+import json
+import hashlib
+import uuid
 from dotenv import load_dotenv
 
-def init_es():
+# File with the kNN search and HNSW settings chosen with knn_benchmark.py
+KNN_SETTINGS_PATH = os.getenv("KNN_SETTINGS_PATH", "./data/knn-settings.json")
 
-    print("Initializing Elastic Search...")
+# Settings used when the file does not exist
+DEFAULT_KNN_SETTINGS = {
+    "field": "question_vector",
+    "k": 2,
+    "num_candidates": 10000
+}
 
-    # Load environment variables
-    load_dotenv()
+# This function loads the kNN settings.
+# The file can also contain the HNSW "m" and "ef_construction" settings used when the index is created.
+def load_knn_settings(path=KNN_SETTINGS_PATH):
 
-    # Get Elastic Search URL
-    ELASTIC_URL = os.getenv("ELASTIC_URL")
-    # Get Elastic Search index name
-    ELASTIC_INDEX_NAME = os.getenv("ELASTIC_INDEX_NAME")
-    # Get Sentence Transformer model name
-    SENTENCE_TRANSFORMER_MODEL = os.getenv("SENTENCE_TRANSFORMER_MODEL")
-    
-    # Create Elastic Search client
-    es_client = Elasticsearch(ELASTIC_URL) 
+    settings = dict(DEFAULT_KNN_SETTINGS)
+
+    if os.path.exists(path):
+        with open(path, "r") as settings_file:
+            settings.update(json.load(settings_file))
+
+    return settings
+
+# This function saves the kNN settings
+def save_knn_settings(settings, path=KNN_SETTINGS_PATH):
+    with open(path, "w") as settings_file:
+        json.dump(settings, settings_file, indent=2)
+
+# Dimensions of the sentence transformer embeddings
+EMBEDDING_DIMS = 384
+
+# Index profiles.
+# quantization: None stores float vectors, "int8" stores int8 quantized vectors (int8_hnsw)
+# fields: "all" indexes the three vector fields, "serving" only the field rag searches
+# dims: embeddings are truncated to this many dimensions and normalized again
+INDEX_PROFILES = {
+    "full": {"quantization": None, "fields": "all", "dims": EMBEDDING_DIMS},
+    "int8": {"quantization": "int8", "fields": "all", "dims": EMBEDDING_DIMS},
+    "serving": {"quantization": None, "fields": "serving", "dims": EMBEDDING_DIMS},
+    "compact": {"quantization": "int8", "fields": "serving", "dims": EMBEDDING_DIMS // 2},
+}
+
+# This function returns an index profile with its vector fields resolved.
+# By default the profile set in ELASTIC_INDEX_PROFILE is returned. EMBEDDING_DIMS overrides its dimensions.
+def get_index_profile(name=None):
+
+    name = name or os.getenv("ELASTIC_INDEX_PROFILE", "full")
+    profile = dict(INDEX_PROFILES[name])
+    profile["name"] = name
+
+    if os.getenv("EMBEDDING_DIMS"):
+        profile["dims"] = int(os.getenv("EMBEDDING_DIMS"))
+
+    if profile["fields"] == "serving":
+        profile["fields"] = [load_knn_settings()["field"]]
+    else:
+        profile["fields"] = list(VECTOR_FIELDS)
+
+    return profile
+
+# This function truncates embeddings to the profile dimensions.
+# Truncated embeddings are normalized again so cosine similarity still works.
+def truncate_vectors(vectors, dims):
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+
+    if vectors.shape[-1] <= dims:
+        return vectors
+
+    return normalize(vectors[..., :dims])
+
+# This function estimates the memory the HNSW graphs and vectors of an index need
+def estimate_vector_memory(num_vectors, profile, m=16):
+
+    # Bytes per dimension
+    if profile["quantization"] == "int8":
+        # int8 vectors and one float correction per vector
+        vector_bytes = num_vectors * (profile["dims"] + 4)
+    else:
+        vector_bytes = num_vectors * profile["dims"] * 4
+
+    # HNSW graph neighbours
+    graph_bytes = num_vectors * 4 * m
+
+    return len(profile["fields"]) * (vector_bytes + graph_bytes)
+
+# This function creates the mapping of a vector field
+def vector_field_mapping(m=None, ef_construction=None, dims=EMBEDDING_DIMS, quantization=None):
+
+    mapping = {
+        "type": "dense_vector",
+        "dims": dims,
+        "index": True,
+        "similarity": "cosine",
+        "index_options": {"type": "int8_hnsw" if quantization == "int8" else "hnsw"}
+    }
+
+    # Use the default HNSW settings unless they are set
+    if m:
+        mapping["index_options"]["m"] = m
+    if ef_construction:
+        mapping["index_options"]["ef_construction"] = ef_construction
+
+    return mapping
 
-    # Create index settings
-    index_settings = {
+# This function creates the index settings
+def create_index_settings(m=None, ef_construction=None, profile=None):
+
+    profile = profile or get_index_profile()
+
+    properties = {
+        "id": {"type": "keyword"},
+        "question": {"type": "text"},
+        "answer": {"type": "text"},
+        "content_hash": {"type": "keyword"}
+    }
+
+    # Only the vector fields of the profile are indexed
+    for field in profile["fields"]:
+        properties[field] = vector_field_mapping(m, ef_construction, dims=profile["dims"], quantization=profile["quantization"])
+
+    return {
         "settings": {
             "number_of_shards": 1,
             "number_of_replicas": 0
         },
         "mappings": {
-            "properties": {
-                "id": {"type": "keyword"},
-                "question": {"type": "text"},
-                "answer": {"type": "text"},
-                "question_vector": {
-                    "type": "dense_vector", 
-                    "dims": 384, 
-                    "index": True, 
-                    "similarity": "cosine"},
-                "answer_vector": {
-                    "type": "dense_vector", 
-                    "dims": 384, 
-                    "index": True, 
-                    "similarity": "cosine"},
-                "question_answer_vector": {
-                    "type": "dense_vector", 
-                    "dims": 384, 
-                    "index": True, 
-                    "similarity": "cosine"},
-            }
+            "properties": properties
         }
     }
 
+# This function reads the data file in chunks so that only one chunk
+# of records is kept in memory at any time
+def read_records(path, chunk_size):
+    for chunk in pd.read_csv(path, chunksize=chunk_size):
+        yield chunk.to_dict(orient='records')
+
+# Strings encoded for each vector field
+FIELD_TEXTS = {
+    "question_vector": lambda rec: rec["question"],
+    "answer_vector": lambda rec: rec["answer"],
+    "question_answer_vector": lambda rec: rec["question"] + ' ' + rec["answer"]
+}
+
+# This function encodes a chunk of records in batches.
+# The strings of each vector field of the profile (questions, answers and
+# question + answer strings) are encoded with one encode call per field.
+def encode_records(model, records, batch_size, profile=None):
+
+    profile = profile or get_index_profile()
+
+    for field in profile["fields"]:
+
+        # Encode strings in batches, reusing stored embeddings
+        vectors = truncate_vectors(encode([FIELD_TEXTS[field](rec) for rec in records], batch_size=batch_size, model=model), profile["dims"])
+
+        # Add vectors to records
+        for i, rec in enumerate(records):
+            rec[field] = vectors[i].tolist()
+
+    return records
+
+# This function returns the content hash of a record.
+# The hash changes when the question, the answer or the sentence transformer model changes.
+# encoder is the encoder_id of the model, looked up once per ingest or sync.
+def content_hash(rec, encoder):
+    content = "\x1f".join([encoder, str(rec["question"]), str(rec["answer"])])
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+# This function generates the bulk actions for chunks of records.
+# Records are encoded chunk by chunk so memory use is bounded
+# by the chunk size and not by the size of the data file.
+# The record id is used as document id so that documents can be updated and deleted.
+def generate_actions(model, index_name, chunks, batch_size, progress, profile):
+    encoder = encoder_id()
+    for records in chunks:
+        for rec in records:
+            rec["content_hash"] = content_hash(rec, encoder)
+        for doc in encode_records(model, records, batch_size, profile):
+            yield {
+                "_index": index_name,
+                "_id": str(doc["id"]),
+                "_source": doc
+            }
+        progress.update(len(records))
+
+# This function sends bulk actions to Elastic Search and reports throughput and failures
+def send_actions(es_client, actions, description):
+
+    # Get ingestion settings
+    chunk_size = int(os.getenv("ELASTIC_BULK_CHUNK_SIZE", 500))
+    thread_count = int(os.getenv("ELASTIC_BULK_THREADS", 2))
+    queue_size = int(os.getenv("ELASTIC_BULK_QUEUE_SIZE", 4))
+
+    # Keep counters
+    indexed = 0
+    failures = []
+
+    # Get start time
+    start_time = time.time()
+
+    # Send documents to Elastic Search.
+    # The queue size limits how many chunks are waiting to be sent.
+    for ok, info in parallel_bulk(es_client,
+                                  actions,
+                                  thread_count=thread_count,
+                                  chunk_size=chunk_size,
+                                  queue_size=queue_size,
+                                  raise_on_error=False,
+                                  raise_on_exception=False):
+        if ok:
+            indexed += 1
+        else:
+            failures.append(info)
+
+    # Calculate throughput
+    elapsed = time.time() - start_time
+    docs_per_sec = (indexed + len(failures)) / elapsed if elapsed > 0 else 0.0
+
+    # Report results
+    print(f"{description}: {indexed} documents in {elapsed:.2f}s ({docs_per_sec:.1f} docs/sec).")
+    if failures:
+        print(f"{len(failures)} documents failed:")
+        for failure in failures:
+            print(failure)
+
+    return {
+        'indexed': indexed,
+        'failed': len(failures),
+        'failures': failures,
+        'elapsed': elapsed,
+        'docs_per_sec': docs_per_sec
+    }
+
+# This function indexes records with the bulk helpers.
+# By default all records of the data file are indexed.
+def ingest_records(es_client, model, index_name, path='./data/data.csv', profile=None, chunks=None):
+
+    chunk_size = int(os.getenv("ELASTIC_BULK_CHUNK_SIZE", 500))
+    batch_size = int(os.getenv("ENCODE_BATCH_SIZE", 64))
+
+    if chunks is None:
+        chunks = read_records(path, chunk_size)
+
+    with tqdm(desc="Indexing records", unit="docs") as progress:
+        actions = generate_actions(model, index_name, chunks, batch_size, progress, profile or get_index_profile())
+        return send_actions(es_client, actions, "Indexed")
+
+# This function returns the indexes the alias points to
+def alias_indexes(es_client, alias):
+
+    if not es_client.indices.exists_alias(name=alias):
+        return []
+
+    return list(es_client.indices.get_alias(name=alias).keys())
+
+# This function points the alias to a new index in one atomic action and deletes the old indexes
+def swap_alias(es_client, alias, new_index):
+
+    old_indexes = alias_indexes(es_client, alias)
+
+    actions = [{"remove": {"index": index, "alias": alias}} for index in old_indexes]
+    actions.append({"add": {"index": new_index, "alias": alias}})
+
+    # An index created before aliases were used has the alias name.
+    # It is removed in the same atomic action.
+    if not old_indexes and es_client.indices.exists(index=alias):
+        actions.insert(0, {"remove_index": {"index": alias}})
+
+    es_client.indices.update_aliases(actions=actions)
+
+    for index in old_indexes:
+        es_client.indices.delete(index=index, ignore_unavailable=True)
+
+# This function returns the name of the concrete index behind the alias and its _meta mapping
+def index_meta(es_client, alias):
+    mapping = es_client.indices.get_mapping(index=alias)
+    index = next(iter(mapping.keys()))
+    return index, dict(mapping[index]['mappings'].get('_meta', {}))
+
+# This function updates values of the _meta mapping of the index behind the alias
+def update_index_meta(es_client, alias, **values):
+    index, meta = index_meta(es_client, alias)
+    meta.update(values)
+    es_client.indices.put_mapping(index=index, meta=meta)
+
+# This function marks the index behind the alias as changed.
+# Processes which keep results of the index (the in-process vector index,
+# the cached answers) compare its version with the version they were built from.
+def mark_index_changed(es_client, alias):
+    update_index_meta(es_client, alias, version=uuid.uuid4().hex)
+
+# This function returns the version of the index behind the alias:
+# the name of the concrete index and the mark of its last change
+def index_version(es_client, alias):
+    index, meta = index_meta(es_client, alias)
+    return f"{index}/{meta.get('version', '')}"
+
+# This function returns the hash of the sentence transformer and the index settings.
+# An index built with other settings can't be synced, it is rebuilt.
+def settings_hash(index_settings):
+    settings = hashlib.sha1(encoder_id().encode("utf-8"))
+    settings.update(json.dumps(index_settings, sort_keys=True).encode("utf-8"))
+    return settings.hexdigest()
+
+# This function returns the hash of the data file.
+# The index is only synced or rebuilt when it changes.
+def data_hash(path='./data/data.csv'):
+
+    data = hashlib.sha1()
+
+    with open(path, "rb") as data_file:
+        for block in iter(lambda: data_file.read(1 << 20), b""):
+            data.update(block)
+
+    return data.hexdigest()
+
+# This function builds a new versioned index and switches the alias to it when it is complete.
+# Searches use the old index until the switch. The settings and data hashes are
+# stored in the index mapping.
+def rebuild_index(es_client, alias, index_settings, path='./data/data.csv'):
+
+    # The random suffix keeps the names of indexes built in the same second apart
+    new_index = f"{alias}-v{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+    body = json.loads(json.dumps(index_settings))
+    body["mappings"]["_meta"] = {"settings_hash": settings_hash(index_settings), "data_hash": data_hash(path)}
+    es_client.indices.create(index=new_index, body=body)
+
+    try:
+        # Read, encode and index records chunk by chunk
+        print(f"Building index {new_index}...")
+        ingest_records(es_client, get_encoder(), new_index)
+
+        # Make the new documents searchable
+        es_client.indices.refresh(index=new_index)
+    except Exception:
+        es_client.indices.delete(index=new_index, ignore_unavailable=True)
+        raise
+
+    swap_alias(es_client, alias, new_index)
+
+    return new_index
+
+# This function syncs the index with the data file.
+# Only new and changed records are encoded and indexed, removed records are deleted.
+# Returns the number of indexed and deleted documents.
+def sync_index(es_client, alias, path='./data/data.csv'):
+
+    chunk_size = int(os.getenv("ELASTIC_BULK_CHUNK_SIZE", 500))
+
+    # Write to the index the alias points to
+    index_name = alias_indexes(es_client, alias)[0]
+
+    # Content hashes of the indexed documents
+    print("Reading content hashes...")
+    indexed_hashes = {hit["_id"]: hit["_source"].get("content_hash") for hit in scan(es_client, index=index_name, _source=["content_hash"])}
+
+    # Ids of the records in the data file
+    seen_ids = set()
+
+    # The model is loaded first, a backend which fails validation changes the encoder id
+    model = get_encoder()
+    encoder = encoder_id()
+
+    # This function yields the new and changed records of each chunk
+    def changed_chunks():
+        for records in read_records(path, chunk_size):
+            changed = []
+            for rec in records:
+                seen_ids.add(str(rec["id"]))
+                if indexed_hashes.get(str(rec["id"])) != content_hash(rec, encoder):
+                    changed.append(rec)
+            if changed:
+                yield changed
+
+    # Index new and changed records
+    result = ingest_records(es_client, model, index_name, chunks=changed_chunks())
+
+    # Delete documents of removed records
+    removed_ids = set(indexed_hashes) - seen_ids
+    deleted = send_actions(es_client, ({"_op_type": "delete", "_index": index_name, "_id": doc_id} for doc_id in removed_ids), "Deleted")
+
+    # Make the changes searchable
+    es_client.indices.refresh(index=index_name)
+
+    return {'indexed': result['indexed'], 'deleted': deleted['indexed']}
+
+# This function creates or syncs the index according to the sync mode.
+# Returns whether the index changed.
+def init_es():
+
+    print("Initializing Elastic Search...")
+
+    # Load environment variables
+    load_dotenv()
+
+    # Get Elastic Search index name. It is used as an alias of a versioned index.
+    ELASTIC_INDEX_NAME = os.getenv("ELASTIC_INDEX_NAME")
+
+    # Sync mode: "create" builds the index only when it does not exist,
+    # "delta" re-indexes new and changed records and deletes removed ones,
+    # "rebuild" builds a new index and switches to it when it is complete.
+    # Both only run when the data file changed, and build a new index when the
+    # model or the index settings changed.
+    ELASTIC_SYNC_MODE = os.getenv("ELASTIC_SYNC_MODE", "create")
+    
+    # Get the shared Elastic Search client
+    es_client = get_es_client()
+
+    # Create index settings with the HNSW settings chosen with knn_benchmark.py
+    knn_settings = load_knn_settings()
+    index_settings = create_index_settings(knn_settings.get("m"), knn_settings.get("ef_construction"))
+
     # Set index name
     index_name = ELASTIC_INDEX_NAME
 
-    # Check if index already exists
-    if not es_client.indices.exists(index=index_name):
-
-        # Delete the index if it exists and create a new one
-        es_client.indices.delete(index=index_name, ignore_unavailable=True)
-        es_client.indices.create(index=index_name, body=index_settings)
-
-        # Read data from the data.csv file into a dataframe
-        print("Reading data...")
-        df = pd.read_csv('./data/data.csv')
-
-        # Convert dataframe to dictionary
-        records = df.to_dict(orient='records')
-
-        # Load a model which will be used ro create the embeddings
-        print("Loading model...")
-        model = SentenceTransformer(SENTENCE_TRANSFORMER_MODEL)
-
-        # For each record create an embedding for the question and answer field
-        print("Encoding records...")
-        embeddings = []
-        for rec in tqdm(records):
-            rec["question_vector"] = model.encode(rec["question"]).tolist()
-            rec["answer_vector"] = model.encode(rec["answer"]).tolist()
-            rec["question_answer_vector"] = model.encode(rec["question"] + ' ' + rec["answer"]).tolist()
-            embeddings.append(rec)
-
-        # Add all documents to index
-        print("Indexing records...")
-        for doc in tqdm(embeddings):
-            try:
-                es_client.index(index=index_name, document=doc)
-            except Exception as e:
-                print(e)
-
-        # Done
-        print("DONE.")
-    
+    # What the index was built from
+    meta = index_meta(es_client, index_name)[1] if es_client.indices.exists(index=index_name) else None
+    data = data_hash()
+
+    # Build the index if it doesn't exist, if it was built with other settings and
+    # is synced or rebuilt, or when a rebuild is requested and the data file changed.
+    # An index created before aliases were used has no hashes and is rebuilt too.
+    if (meta is None
+            or (ELASTIC_SYNC_MODE in ("delta", "rebuild") and meta.get("settings_hash") != settings_hash(index_settings))
+            or (ELASTIC_SYNC_MODE == "rebuild" and meta.get("data_hash") != data)):
+
+        rebuild_index(es_client, index_name, index_settings)
+        changed = True
+
+    elif ELASTIC_SYNC_MODE == "delta" and meta.get("data_hash") != data:
+
+        print("Syncing index...")
+        result = sync_index(es_client, index_name)
+        changed = result['indexed'] > 0 or result['deleted'] > 0
+
+        # The index is in sync with this data file
+        update_index_meta(es_client, index_name, data_hash=data)
+
     else:
 
-        print("Index is already created.")
-        print("DONE.")
+        print("Index is up to date.")
+        changed = False
+
+    if changed:
+
+        # Processes using the index drop what they built from the old one
+        mark_index_changed(es_client, index_name)
+
+        # Remove the saved in-process vector index so that it is rebuilt from the new index
+        delete_saved_index(os.getenv("VECTOR_INDEX_PATH", "./data/vector_index"))
+
+        # Cached answers were based on the old index
+        answer_cache.invalidate()
+
+    # Done
+    print("DONE.")
+
+    return changed
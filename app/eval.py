@@ -1,31 +1,93 @@
 import pandas as pd
-from openai import OpenAI
+import numpy as np
 import os
 from dotenv import load_dotenv
 from tqdm.auto import tqdm
 import json
-from rag import rag, elastic_text_search, elastic_vector_search
-from sentence_transformers import SentenceTransformer
+import csv
+import random
+import time
+import openai
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from rag import rag, text_search_batch, vector_search_batch, hybrid_search_batch, encode_queries, elastic_msearch, vector_search_body, index_name, KNN_SETTINGS
+from es import get_index_profile, create_index_settings, ingest_records, truncate_vectors, estimate_vector_memory, load_knn_settings, INDEX_PROFILES
+from resources import get_encoder, get_es_client, get_openai_client
+from embedding_store import encode
+from encoder_backend import encoder_id
 
 # Load environment variables
 load_dotenv()
 
-# Get Sentence Transformer model name
-SENTENCE_TRANSFORMER_MODEL = os.getenv("SENTENCE_TRANSFORMER_MODEL")
-model = SentenceTransformer(SENTENCE_TRANSFORMER_MODEL)
-
-# Open AI
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
-
 # Open AI model
 OPENAI_MODEL = os.getenv("OPENAI_MODEL")
 
-# Create Open AI client
-ai_client = OpenAI()
+# Ground truth generation settings
+GROUND_TRUTH_WORKERS = int(os.getenv("GROUND_TRUTH_WORKERS", 4))
+GROUND_TRUTH_CHECKPOINT = os.getenv("GROUND_TRUTH_CHECKPOINT", "./data/ground-truth-checkpoint.jsonl")
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 6))
+
+# Open AI errors which are worth retrying
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+# This function calls an Open AI function and retries with exponential backoff
+# when the request is rate limited or fails temporarily
+def call_with_backoff(function, *args, **kwargs):
+
+    for attempt in range(OPENAI_MAX_RETRIES):
+        try:
+            return function(*args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            if attempt == OPENAI_MAX_RETRIES - 1:
+                raise
+
+            # Use the delay suggested by the server if there is one
+            delay = None
+            response = getattr(e, 'response', None)
+            if response is not None and response.headers.get('retry-after'):
+                try:
+                    delay = float(response.headers['retry-after'])
+                except ValueError:
+                    pass
+            if delay is None:
+                delay = min(60, 2 ** attempt) + random.uniform(0, 1)
+
+            time.sleep(delay)
+
+# This function generates and parses the questions for a record.
+# Answers which are not parsable JSON are generated again.
+def generate_record_questions(rec):
+
+    for attempt in range(OPENAI_MAX_RETRIES):
+        try:
+            questions = json.loads(call_with_backoff(generate_questions, rec))
+            if isinstance(questions, list):
+                return questions
+        except json.JSONDecodeError:
+            pass
+
+    raise ValueError(f"Could not generate questions for record {rec['id']}")
+
+# This function loads the questions already generated from the checkpoint file
+def load_ground_truth_checkpoint(path=GROUND_TRUTH_CHECKPOINT):
+
+    results = {}
+
+    if os.path.exists(path):
+        with open(path, 'r') as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Partly written last line
+                    continue
+                results[entry['id']] = entry['questions']
+
+    return results
 
-# This function is used to generate the ground truth data
-def generate_ground_truth_data():
+# This function is used to generate the ground truth data.
+# Questions are generated concurrently and each record is saved to the checkpoint file
+# as soon as it is done, so that a restart continues where the previous run stopped.
+def generate_ground_truth_data(workers=GROUND_TRUTH_WORKERS, checkpoint_path=GROUND_TRUTH_CHECKPOINT):
 
     # Read data from the csv file
     df = pd.read_csv('./data/data.csv')
@@ -33,34 +95,42 @@ def generate_ground_truth_data():
     # Populate documents
     records = df.to_dict(orient='records')
 
-    # Dictionary to store the results
-    results = {}
+    # Questions already generated by a previous run
+    results = load_ground_truth_checkpoint(checkpoint_path)
 
-    # Iterate through all records
-    for rec in tqdm(records): 
-        rec_id = rec['id']
-        if rec_id in results:
-            continue
-        
-        # Generate 5 questions for each record
-        questions = generate_questions(rec)
-        results[rec_id] = questions    
-   
-    # Parse the results
-    parsed_results = {}
-
-    for rec_id, json_questions in results.items():
-        parsed_results[rec_id] = json.loads(json_questions)
+    # Records still to be done
+    pending = [rec for rec in records if rec['id'] not in results]
 
-    # Create a record index
-    rec_index = {r['id']: r for r in records}
+    failed = []
+
+    # Generate 5 questions for each record
+    with open(checkpoint_path, 'a') as checkpoint_file, ThreadPoolExecutor(max_workers=workers) as executor:
+
+        futures = {executor.submit(generate_record_questions, rec): rec for rec in pending}
+
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            rec = futures[future]
+            try:
+                questions = future.result()
+            except Exception as e:
+                print(e)
+                failed.append(rec['id'])
+                continue
+
+            # Save record to the checkpoint file
+            results[rec['id']] = questions
+            checkpoint_file.write(json.dumps({'id': rec['id'], 'questions': questions}) + '\n')
+            checkpoint_file.flush()
 
-    # Create a dataframe
+    if failed:
+        print(f"Questions could not be generated for records {failed}. Run again to retry them.")
+
+    # Create a dataframe in record order
     final_results = []
 
-    for rec_id, questions in parsed_results.items():
-        for q in questions:
-            final_results.append((q, rec_id))
+    for rec in records:
+        for q in results.get(rec['id'], []):
+            final_results.append((q, rec['id']))
 
     df = pd.DataFrame(final_results, columns=['question', 'id'])
 
@@ -87,7 +157,7 @@ def generate_questions(doc):
     # Generate prompt
     prompt = prompt_template.format(**doc)
 
-    response = ai_client.chat.completions.create(
+    response = get_openai_client().chat.completions.create(
         model=OPENAI_MODEL,
         messages=[{"role": "user", "content": prompt}]
     )
@@ -108,127 +178,277 @@ def load_ground_truth_data():
     return gtd_dict
 
 # This function evaluates our text search retrieval
-def evaluate_text_search_retrieval():
-    
+def evaluate_text_search_retrieval(k=2):
+    return evaluate_retrieval(["text"], k=k)["text"]
+
+# This function evaluates our vector search retrieval
+def evaluate_vector_search_retrieval(field, k=2):
+    return evaluate_retrieval([field], k=k)[field]
+
+# This function evaluates several retrieval methods in one pass.
+# Methods are "text", "hybrid" (text and question vector search combined)
+# or the name of a vector field. The ground truth questions
+# are encoded once and the encoded questions are used for every vector field.
+# Searches are sent with _msearch, chunk_size searches per round trip.
+# Returns a dictionary with the hit rate and MRR of each method.
+def evaluate_retrieval(methods, k=2, chunk_size=100):
+
     # Load ground truth data
     gtd = load_ground_truth_data()
+    questions = [rec['question'] for rec in gtd]
+    ids = [rec['id'] for rec in gtd]
 
-    # List to store all checks
-    total_relevance = []
+    # Questions are encoded on first use
+    query_vectors = None
 
-    # Iterate through records
-    for rec in tqdm(gtd):
-        # Get record id
-        rec_id = rec['id']
-        # Perform a text search with the record question
-        results = elastic_text_search(query=rec['question'])
-         # List to store if record is relevant
-        relevance = []
-        for r in results:
-            relevance.append(r['id'] == rec_id)
+    metrics = {}
 
-        # Add each record relevance to total relevance
-        total_relevance.append(relevance)
+    for method in tqdm(methods):
 
-    # Show hit rate
-    hit_rate = calculate_hit_rate(total_relevance=total_relevance)
-    mrr = calculate_mrr(total_relevance=total_relevance)
+        if method == "text":
+            # Perform a text search with all record questions
+            results = text_search_batch(questions, k=k, chunk_size=chunk_size)
+        else:
+            # Encode all record questions at once
+            if query_vectors is None:
+                query_vectors = encode_queries(questions)
 
-    return hit_rate, mrr
+            if method == "hybrid":
+                # Perform a hybrid search with all record questions on the field rag searches
+                results = hybrid_search_batch(questions, KNN_SETTINGS["field"], query_vectors=query_vectors, k=k, chunk_size=chunk_size)
+            else:
+                # Perform a vector search with all record questions
+                results = vector_search_batch(method, questions, query_vectors=query_vectors, k=k, chunk_size=chunk_size)
 
-# This function evaluates our vector search retrieval
-def evaluate_vector_search_retrieval(field):
+        # Check which results are relevant
+        total_relevance = relevance_matrix(ids, results, k)
 
-    # Load ground truth data
+        metrics[method] = (calculate_hit_rate(total_relevance), calculate_mrr(total_relevance))
+
+    return metrics
+
+# This function evaluates the index profiles (see es.py).
+# For every profile a temporary index is built and the serving vector field is
+# evaluated on the ground truth data. Returns a dataframe with the estimated vector memory,
+# the index size, hit rate and MRR of each profile and the memory saved and
+# the hit rate and MRR lost against the full profile.
+def evaluate_index_profiles(profiles=tuple(INDEX_PROFILES), k=2):
+
+    es_client = get_es_client()
+    field = load_knn_settings()["field"]
+
+    # Load ground truth data and encode the questions once
     gtd = load_ground_truth_data()
+    ids = [rec['id'] for rec in gtd]
+    question_vectors = encode([rec['question'] for rec in gtd], batch_size=int(os.getenv("ENCODE_BATCH_SIZE", 64)))
+
+    rows = []
+
+    for name in profiles:
+
+        profile = get_index_profile(name)
+        profile_index = f"{index_name}-profile-{name}"
+
+        # Build a temporary index with the profile
+        es_client.indices.delete(index=profile_index, ignore_unavailable=True)
+        es_client.indices.create(index=profile_index, body=create_index_settings(profile=profile))
+
+        try:
+            ingestion = ingest_records(es_client, get_encoder(), profile_index, profile=profile)
+            es_client.indices.forcemerge(index=profile_index, max_num_segments=1)
+            es_client.indices.refresh(index=profile_index)
+
+            # Search the serving field with questions truncated like the indexed vectors
+            query_vectors = truncate_vectors(question_vectors, profile["dims"])
+            results = elastic_msearch([vector_search_body(field, query_v, k=k) for query_v in query_vectors], index=profile_index)
+            total_relevance = relevance_matrix(ids, results, k)
+
+            stats = es_client.indices.stats(index=profile_index, metric="store")
+
+            rows.append({
+                'profile': name,
+                'fields': len(profile["fields"]),
+                'dims': profile["dims"],
+                'quantization': profile["quantization"] or "float",
+                'estimated_vector_memory': estimate_vector_memory(ingestion['indexed'], profile),
+                'index_size': stats['indices'][profile_index]['total']['store']['size_in_bytes'],
+                'hit_rate': calculate_hit_rate(total_relevance),
+                'mrr': calculate_mrr(total_relevance)
+            })
+        finally:
+            es_client.indices.delete(index=profile_index, ignore_unavailable=True)
+
+    df = pd.DataFrame(rows)
+
+    # Compare with the full profile, or with the first profile when full was not evaluated
+    baseline = df[df['profile'] == 'full'].iloc[0] if (df['profile'] == 'full').any() else df.iloc[0]
+    df['memory_saved'] = 1 - df['estimated_vector_memory'] / baseline['estimated_vector_memory']
+    df['hit_rate_lost'] = baseline['hit_rate'] - df['hit_rate']
+    df['mrr_lost'] = baseline['mrr'] - df['mrr']
 
-    # List to store all checks
-    total_relevance = []
+    return df
 
-    # Iterate through records
-    for rec in tqdm(gtd):
-        # Get record id
-        rec_id = rec['id']
-        # Perform a text search with the record question
-        results = elastic_vector_search(field=field, query=rec['question'])
-         # List to store if record is relevant
-        relevance = []
-        for r in results:
-            relevance.append(r['id'] == rec_id)
+# This function creates the relevance matrix.
+# Row i, column j is True if the j-th result of question i is the record the question was generated from.
+def relevance_matrix(ids, results, k):
 
-        # Add each record relevance to total relevance
-        total_relevance.append(relevance)
+    # Ids of the results, padded with None when there are less than k results
+    result_ids = np.full((len(results), k), None, dtype=object)
+    for i, docs in enumerate(results):
+        result_ids[i, :len(docs[:k])] = [doc['id'] for doc in docs[:k]]
 
-    # Show hit rate
-    hit_rate = calculate_hit_rate(total_relevance=total_relevance)
-    mrr = calculate_mrr(total_relevance=total_relevance)
+    return result_ids == np.asarray(ids, dtype=object)[:, None]
 
-    return hit_rate, mrr
+# This function converts a list of relevance rows to a boolean matrix
+def as_relevance_matrix(total_relevance):
+
+    if isinstance(total_relevance, np.ndarray):
+        return total_relevance.astype(bool)
+
+    width = max((len(row) for row in total_relevance), default=0)
+    matrix = np.zeros((len(total_relevance), width), dtype=bool)
+    for i, row in enumerate(total_relevance):
+        matrix[i, :len(row)] = row
+
+    return matrix
 
 # Function to calculate Hit Rate.
-# If id is in results increase hit by 1
-# Finally divide total hits by length of total relevance
+# A question is a hit if the relevant record is in its results.
+# Hit rate is the fraction of questions which are hits.
 def calculate_hit_rate(total_relevance):
-    hits=0
-    for row in total_relevance:
-        for col in row:
-            if col == True:
-                hits +=1
-    return hits / len(total_relevance)
+    matrix = as_relevance_matrix(total_relevance)
+    return float(matrix.any(axis=1).mean())
 
 # Function to calculate MRR
-# Works almost as Hit Rate but instead of increasing hits by 1 
-# the increase rate takes the position in consideration.
+# Works almost as Hit Rate but instead of counting a hit as 1
+# the position of the first relevant result is taken into consideration.
 # Rate is 1 / Position
 def calculate_mrr(total_relevance):
-    hits=0.0
-    for row in total_relevance:
-        for col in row:
-            if row[col] == True:
-                hits = hits + 1 / (col + 1) 
-    return hits / len(total_relevance)
-
-# This function is used to generate the offline RAG evaluation data
-def generate_offline_rag_evaluation_data(model):
-    
+    matrix = as_relevance_matrix(total_relevance)
+    reciprocal_ranks = 1.0 / np.arange(1, matrix.shape[1] + 1)
+    return float((matrix * reciprocal_ranks).max(axis=1, initial=0.0).mean())
+
+# Offline RAG evaluation settings
+RAG_EVALUATION_MODELS = os.getenv("RAG_EVALUATION_MODELS", "gpt-3.5-turbo,gpt-4o-mini").split(",")
+RAG_EVALUATION_WORKERS = int(os.getenv("RAG_EVALUATION_WORKERS", 4))
+
+# This function returns the offline RAG evaluation results file of a model,
+# eg ./data/gpt-35-turbo-results.csv for gpt-3.5-turbo
+def rag_results_file(model):
+    return f"./data/{model.replace('.', '')}-results.csv"
+
+# This function opens a results file for appending.
+# Returns the file, a csv writer using the columns of the existing file,
+# the (id, question) pairs already answered and the next row number.
+def open_rag_results_file(path):
+
+    columns = ['', 'id', 'question', 'llm_answer', 'original_answer']
+    answered = set()
+    row_count = 0
+
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        existing = pd.read_csv(path, keep_default_na=False)
+        columns = ['' if c.startswith('Unnamed') else c for c in existing.columns]
+        answered = set(zip(existing['id'], existing['question']))
+        row_count = len(existing)
+
+    results_file = open(path, 'a', newline='')
+    writer = csv.DictWriter(results_file, fieldnames=columns, extrasaction='ignore')
+    if row_count == 0:
+        writer.writeheader()
+
+    return results_file, writer, answered, row_count
+
+# This function is used to generate the offline RAG evaluation data.
+# Questions of all models are answered concurrently and every answer is appended
+# to the results file of its model as soon as it is ready.
+# Questions already in a results file are skipped, so an interrupted run can be continued.
+def generate_offline_rag_evaluation_data(models=RAG_EVALUATION_MODELS, workers=RAG_EVALUATION_WORKERS):
+
+    if isinstance(models, str):
+        models = [models]
+
     # Read data from the data.csv file into a dataframe
     df = pd.read_csv('./data/data.csv')
 
-    # Convert dataframe to dictionary
-    records = df.to_dict(orient='records')
+    # Create a record index
+    rec_index = {r['id']: r for r in df.to_dict(orient='records')}
 
     # Load Ground Truth data
     ground_truth = load_ground_truth_data()
 
-    # For each question in ground truth data generate an answer
-    answers = []
-
-    for record in ground_truth:
-        llm_answer = rag(record['question'], model=model)
-        record_id = record['id']
-        original_answer = records[record_id]['answer']
-        question = record['question']
-        answers.append({
-            'id': record_id,
-            'question': question,
-            'llm_answer': llm_answer,
-            'original_answer': original_answer 
-        })
-
-        # Create results data frame
-        df = pd.DataFrame([{'id': record['id'], 
-                            'question': record['question'], 
-                            'llm_answer': record['llm_answer']['answer'], 
-                            'original_answer': record['original_answer']} for record in answers])
-        
-        # Save results to csv file
-        # gpt-35-turbo
-        if model == 'gpt-3.5-turbo':
-            df.to_csv('./data/gpt-35-turbo-results.csv')
-
-        # gpt-4o-mini
-        if model == 'gpt-4o-mini':
-             df.to_csv('./data/gpt-4o-mini-results.csv')
+    # Open the results file of each model
+    outputs = {model: open_rag_results_file(rag_results_file(model)) for model in models}
+
+    def answer(model, record):
+        return rag(record['question'], model=model, use_cache=False)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+
+            # For each question in ground truth data generate an answer with every model
+            futures = {}
+            for model in models:
+                answered = outputs[model][2]
+                for record in ground_truth:
+                    if (record['id'], record['question']) not in answered:
+                        futures[executor.submit(answer, model, record)] = (model, record)
+
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                model, record = futures[future]
+                try:
+                    llm_answer = future.result()
+                except Exception as e:
+                    print(f"{model}: {record['question']}: {e}")
+                    continue
+
+                # Append result to the results file of the model
+                results_file, writer, answered, row_count = outputs[model]
+                writer.writerow({'': row_count,
+                                 'id': record['id'],
+                                 'question': record['question'],
+                                 'llm_answer': llm_answer['answer'],
+                                 'original_answer': rec_index[record['id']]['answer']})
+                results_file.flush()
+                outputs[model] = (results_file, writer, answered, row_count + 1)
+    finally:
+        for results_file, _, _, _ in outputs.values():
+            results_file.close()
+
+# File where the embeddings of the original answers are kept between runs
+REFERENCE_EMBEDDINGS_PATH = os.getenv("REFERENCE_EMBEDDINGS_PATH", "./data/reference-embeddings.npz")
+
+# This function encodes texts in batches to unit length vectors.
+# LLM answers are only encoded once, so they are not kept in the embedding store.
+def encode_normalized(texts):
+    return np.asarray(get_encoder().encode(list(texts),
+                                           batch_size=int(os.getenv("ENCODE_BATCH_SIZE", 64)),
+                                           normalize_embeddings=True), dtype=np.float32)
+
+# This function returns the embeddings of the original answers.
+# Embeddings are saved to a file and reused by every model and run,
+# only answers which are not in the file yet are encoded.
+def load_reference_embeddings(texts, path=REFERENCE_EMBEDDINGS_PATH):
+
+    model_name = encoder_id()
+    saved = {}
+
+    # Load saved embeddings of the same sentence transformer model
+    if os.path.exists(path):
+        data = np.load(path, allow_pickle=False)
+        if str(data['model']) == model_name:
+            saved = dict(zip(data['texts'].tolist(), data['vectors']))
+
+    # Encode missing answers
+    missing = sorted(set(texts) - set(saved))
+    if missing:
+        saved.update(zip(missing, encode_normalized(missing)))
+        np.savez(path,
+                 model=np.array(model_name),
+                 texts=np.array(list(saved.keys())),
+                 vectors=np.stack(list(saved.values())))
+
+    return np.stack([saved[text] for text in texts])
 
 # This function calculates cosine similarity
 def calculate_cosine_similarity(record):
@@ -238,38 +458,32 @@ def calculate_cosine_similarity(record):
     llm_answer = record['llm_answer']
 
     # Calculate vectors
-    original_answer_v = model.encode(original_answer)
-    llm_answer_v = model.encode(llm_answer)
+    original_answer_v = get_encoder().encode(original_answer)
+    llm_answer_v = get_encoder().encode(llm_answer)
 
     # Return similarity
     return llm_answer_v.dot(original_answer_v)
 
-# This function calculates similarities
+# This function calculates similarities.
+# All answers are encoded in batches and the similarities are calculated
+# with one matrix operation on unit length vectors.
 def calculate_similarities(model):
     # Read results
-    # gpt-35-turbo
-    if model == 'gpt-3.5-turbo':
-        df = pd.read_csv('./data/gpt-35-turbo-results.csv')
-    
-    # gpt-4o-mini
-    if model == 'gpt-4o-mini':
-        df = pd.read_csv('./data/gpt-4o-mini-results.csv')
-    
-    # Convert dataset to dict
-    results = df.to_dict(orient='records')
+    df = pd.read_csv(rag_results_file(model))
 
-    # Calculate similarity for each record
-    similarities = []
+    # Get original and llm answers
+    original_answers = df['original_answer'].fillna('').astype(str).tolist()
+    llm_answers = df['llm_answer'].fillna('').astype(str).tolist()
 
-    for record in results:
-        similarity = calculate_cosine_similarity(record)
-        similarities.append(similarity)
+    # Calculate vectors
+    original_answer_v = load_reference_embeddings(original_answers)
+    llm_answer_v = encode_normalized(llm_answers)
 
     # Add cosine column to Dataframe
-    df['cosine'] = similarities
+    df['cosine'] = np.einsum('ij,ij->i', llm_answer_v, original_answer_v)
 
     # Describe column
     column_description = dict(df['cosine'].describe())
 
     # Return column column description
-    return column_description, df['cosine']
\ No newline at end of file
+    return column_description, df['cosine']
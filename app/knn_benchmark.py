@@ -0,0 +1,166 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from tqdm.auto import tqdm
+from es import create_index_settings, load_knn_settings, save_knn_settings, KNN_SETTINGS_PATH
+from rag import index_name, vector_search_body, encode_queries
+from eval import load_ground_truth_data, relevance_matrix, calculate_hit_rate, calculate_mrr
+from resources import get_es_client
+
+# kNN parameter sweep.
+# For every combination of HNSW m / ef_construction, vector field, k and num_candidates
+# the ground truth questions are searched one by one and the search latency
+# percentiles are measured next to hit rate and MRR.
+# The Pareto optimal settings are printed and the chosen settings are written
+# to the kNN settings file which rag.py and es.py read at startup.
+
+# This function creates a copy of the index with the given HNSW settings.
+# Documents are copied with _reindex so they are not encoded again.
+def build_benchmark_index(es_client, m, ef_construction):
+
+    name = f"{index_name}-bench-m{m}-ef{ef_construction}"
+
+    if not es_client.indices.exists(index=name):
+        es_client.indices.create(index=name, body=create_index_settings(m, ef_construction))
+        es_client.reindex(body={"source": {"index": index_name}, "dest": {"index": name}}, wait_for_completion=True, refresh=True)
+        # One segment per index so that all indexes are searched the same way
+        es_client.indices.forcemerge(index=name, max_num_segments=1)
+
+    return name
+
+# This function searches all query vectors one by one.
+# Returns the latency of every search in milliseconds and the results.
+def run_searches(es_client, name, field, query_vectors, k, num_candidates, warm_up=10):
+
+    # Warm up caches before measuring
+    for query_v in query_vectors[:warm_up]:
+        es_client.search(index=name, body=vector_search_body(field, query_v, k=k, num_candidates=num_candidates))
+
+    latencies = []
+    results = []
+
+    for query_v in query_vectors:
+        start_time = time.perf_counter()
+        response = es_client.search(index=name, body=vector_search_body(field, query_v, k=k, num_candidates=num_candidates))
+        latencies.append((time.perf_counter() - start_time) * 1000)
+        results.append([hit['_source'] for hit in response['hits']['hits']])
+
+    return np.array(latencies), results
+
+# This function marks the settings which are not beaten by other settings
+# on both latency (p95) and quality (MRR)
+def pareto_front(df):
+
+    p95 = df['p95_ms'].to_numpy()
+    mrr = df['mrr'].to_numpy()
+
+    # Row j dominates row i if it is at least as good on both and better on one
+    dominated = ((p95[None, :] <= p95[:, None]) & (mrr[None, :] >= mrr[:, None]) &
+                 ((p95[None, :] < p95[:, None]) | (mrr[None, :] > mrr[:, None]))).any(axis=1)
+
+    return ~dominated
+
+# This function chooses the fastest Pareto optimal settings
+# whose MRR is within the tolerance of the best MRR
+def choose_settings(df, mrr_tolerance):
+
+    candidates = df[df['pareto'] & (df['mrr'] >= df['mrr'].max() - mrr_tolerance)]
+    best = candidates.sort_values(['p95_ms', 'mrr'], ascending=[True, False]).iloc[0]
+
+    return {
+        "field": best['field'],
+        "k": int(best['k']),
+        "num_candidates": int(best['num_candidates']),
+        "m": int(best['m']),
+        "ef_construction": int(best['ef_construction'])
+    }
+
+# This function runs the sweep
+def run_benchmark(fields, ks, num_candidates_values, ms, ef_constructions, sample=None, keep_indexes=False):
+
+    es_client = get_es_client()
+
+    # Load and encode ground truth questions once
+    gtd = load_ground_truth_data()
+    if sample:
+        gtd = pd.DataFrame(gtd).sample(n=min(sample, len(gtd)), random_state=1).to_dict(orient='records')
+    ids = [rec['id'] for rec in gtd]
+    query_vectors = encode_queries([rec['question'] for rec in gtd])
+
+    rows = []
+
+    for m in ms:
+        for ef_construction in ef_constructions:
+
+            name = build_benchmark_index(es_client, m, ef_construction)
+
+            try:
+                for field in fields:
+                    for k in ks:
+                        for num_candidates in tqdm(num_candidates_values, desc=f"m={m} ef={ef_construction} {field} k={k}"):
+
+                            # num_candidates must be at least k
+                            if num_candidates < k:
+                                continue
+
+                            latencies, results = run_searches(es_client, name, field, query_vectors, k, num_candidates)
+                            total_relevance = relevance_matrix(ids, results, k)
+
+                            rows.append({
+                                'm': m,
+                                'ef_construction': ef_construction,
+                                'field': field,
+                                'k': k,
+                                'num_candidates': num_candidates,
+                                'p50_ms': np.percentile(latencies, 50),
+                                'p95_ms': np.percentile(latencies, 95),
+                                'p99_ms': np.percentile(latencies, 99),
+                                'hit_rate': calculate_hit_rate(total_relevance),
+                                'mrr': calculate_mrr(total_relevance)
+                            })
+            finally:
+                if not keep_indexes:
+                    es_client.indices.delete(index=name, ignore_unavailable=True)
+
+    df = pd.DataFrame(rows)
+    df['pareto'] = pareto_front(df)
+
+    return df
+
+def main():
+
+    parser = argparse.ArgumentParser(description="kNN parameter sweep: search latency against hit rate and MRR")
+    parser.add_argument("--fields", nargs="+", default=["question_vector", "answer_vector", "question_answer_vector"])
+    parser.add_argument("--k", nargs="+", type=int, default=[2])
+    parser.add_argument("--num-candidates", nargs="+", type=int, default=[10, 50, 100, 1000, 10000])
+    parser.add_argument("--m", nargs="+", type=int, default=[16, 32])
+    parser.add_argument("--ef-construction", nargs="+", type=int, default=[100, 200])
+    parser.add_argument("--sample", type=int, default=None, help="Number of ground truth questions to use (default: all)")
+    parser.add_argument("--mrr-tolerance", type=float, default=0.01, help="MRR the chosen settings may lose against the best settings")
+    parser.add_argument("--output", default="./data/knn-benchmark.csv", help="CSV file for the full results table")
+    parser.add_argument("--settings", default=KNN_SETTINGS_PATH, help="File the chosen settings are written to")
+    parser.add_argument("--no-save", action="store_true", help="Do not write the chosen settings")
+    parser.add_argument("--keep-indexes", action="store_true", help="Keep the benchmark indexes")
+    args = parser.parse_args()
+
+    df = run_benchmark(args.fields, args.k, args.num_candidates, args.m, args.ef_construction,
+                       sample=args.sample, keep_indexes=args.keep_indexes)
+    df.to_csv(args.output, index=False)
+
+    # Print Pareto table
+    print("Pareto optimal settings:")
+    print(df[df['pareto']].sort_values('p95_ms').to_string(index=False, float_format=lambda x: f"{x:.4f}"))
+
+    # Choose and save settings
+    settings = choose_settings(df, args.mrr_tolerance)
+    print(f"Chosen settings: {settings}")
+
+    if not args.no_save:
+        current = load_knn_settings(args.settings)
+        current.update(settings)
+        save_knn_settings(current, args.settings)
+        print(f"Settings written to {args.settings}. Rebuild the index to apply m and ef_construction.")
+
+if __name__ == "__main__":
+    main()
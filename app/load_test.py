@@ -0,0 +1,383 @@
+import argparse
+import json
+import os
+import random
+import resource
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+
+# Offline load test.
+# Simulated users go through the Assistant flow (question, answer, feedback)
+# against a local Open AI compatible stub server, so the throughput of the
+# rag -> insert_dialog path can be measured without Open AI.
+# Search runs in process on the numpy vector index built from the data file,
+# or against the Elastic Search instance of ELASTIC_URL.
+# Requests per second, per-stage latency percentiles, CPU and RSS are printed
+# and saved as JSON, and can be compared with the results of an earlier run.
+
+# Stub server settings, set from the command line
+STUB_SETTINGS = {
+    # Seconds until the whole answer is returned
+    "latency": 0.5,
+    # Seconds until the first token of a streamed answer
+    "first_token_latency": 0.1,
+    # Tokens of each answer
+    "completion_tokens": 50
+}
+
+# Open AI compatible chat completions stub.
+# Answers with the configured latency and token count, streamed or not.
+# Relevance prompts get a parsable relevance judgement.
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = " ".join(message["content"] for message in request["messages"])
+
+        # Roughly four characters per token
+        prompt_tokens = max(1, len(prompt) // 4)
+
+        if '"Relevance"' in prompt:
+            tokens = ['{"Relevance": "Relevant"}']
+        else:
+            tokens = ["token "] * STUB_SETTINGS["completion_tokens"]
+
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens)
+        }
+
+        if request.get("stream"):
+            self.stream(request["model"], tokens, usage)
+        else:
+            time.sleep(STUB_SETTINGS["latency"])
+            self.send_json({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+    # This function sends a JSON response
+    def send_json(self, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # This function streams the tokens as server-sent events.
+    # The first token is sent after the first token latency and the rest
+    # are spread over the remaining latency. The last event has the usage.
+    def stream(self, model, tokens, usage):
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(choices, usage=None):
+            event = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": choices, "usage": usage}
+            self.send_chunk(f"data: {json.dumps(event)}\n\n")
+
+        time.sleep(STUB_SETTINGS["first_token_latency"])
+        interval = max(0.0, STUB_SETTINGS["latency"] - STUB_SETTINGS["first_token_latency"]) / len(tokens)
+
+        for i, token in enumerate(tokens):
+            if i > 0:
+                time.sleep(interval)
+            chunk([{"index": 0, "delta": {"content": token}, "finish_reason": None}])
+
+        chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        chunk([], usage)
+        self.send_chunk("data: [DONE]\n\n")
+        self.send_chunk("")
+
+    # This function writes one chunk of a chunked response
+    def send_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+# This function starts the stub server in a background thread.
+# Returns the server and its base URL.
+def start_stub_server(host="127.0.0.1", port=0):
+
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="openai-stub", daemon=True).start()
+
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+# This function builds the in-process vector index from the data file,
+# so that no Elastic Search instance is needed
+def build_local_index(path):
+
+    from es import read_records, encode_records, get_index_profile
+    from vector_index import NumpyVectorIndex, normalize
+    from resources import get_encoder
+
+    profile = get_index_profile()
+    records = [rec for chunk in read_records(path, chunk_size=1000) for rec in chunk]
+    encode_records(get_encoder(), records, batch_size=int(os.getenv("ENCODE_BATCH_SIZE", 64)), profile=profile)
+
+    docs = [{"id": rec["id"], "question": rec["question"], "answer": rec["answer"]} for rec in records]
+    vectors = {field: normalize(np.asarray([rec[field] for rec in records], dtype=np.float32)) for field in profile["fields"]}
+
+    return NumpyVectorIndex(docs, vectors)
+
+# This function returns the resident set size of the process in MB
+def current_rss_mb():
+    with open("/proc/self/statm", "r") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+# This function returns the p50, p99 and mean of a list of durations in milliseconds
+def latency_summary(durations):
+    values = np.asarray(durations) * 1000
+    return {
+        "count": len(values),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "mean_ms": float(values.mean())
+    }
+
+# This function runs the Assistant flow of one simulated user
+def run_user(questions, requests, args, record):
+
+    import rag
+    from postgres import insert_dialog, insert_feedback
+
+    for _ in range(requests):
+
+        question = random.choice(questions)
+        start = time.time()
+
+        try:
+            if args.stream:
+                response = {}
+                for _ in rag.rag_stream(question, response, model=args.model, use_cache=args.semantic_cache, relevance_mode=args.relevance_mode):
+                    pass
+            else:
+                response = rag.rag(question, model=args.model, use_cache=args.semantic_cache, relevance_mode=args.relevance_mode)
+
+            stages = {span["stage"]: span["duration"] for span in response["spans"]}
+
+            if args.postgres:
+                dialog_id = str(uuid.uuid4())
+
+                insert_start = time.time()
+                insert_dialog(dialog_id, question, response)
+                stages["insert_dialog"] = time.time() - insert_start
+
+                if random.random() < args.feedback_rate:
+                    feedback_start = time.time()
+                    insert_feedback(dialog_id, random.choice([1, -1]))
+                    stages["insert_feedback"] = time.time() - feedback_start
+
+            stages["total"] = time.time() - start
+            record(stages, None)
+
+        except Exception as e:
+            record(None, e)
+
+        if args.think_time:
+            time.sleep(random.uniform(0, 2 * args.think_time))
+
+# This function runs the load test and returns the results
+def run_load_test(args):
+
+    import rag
+    from resources import warm_up
+    from batch_encoder import batch_encoder
+
+    # Point the Open AI client to the stub server
+    if args.openai_url is None:
+        STUB_SETTINGS.update(latency=args.llm_latency, first_token_latency=args.first_token_latency, completion_tokens=args.completion_tokens)
+        _, args.openai_url = start_stub_server()
+    os.environ["OPENAI_BASE_URL"] = args.openai_url
+    if not os.getenv("OPENAI_API_KEY"):
+        os.environ["OPENAI_API_KEY"] = "stub"
+
+    if args.search == "numpy":
+        print("Building the in-process vector index...")
+        rag.vector_index = build_local_index(args.data)
+        rag.RETRIEVAL_BACKEND = "numpy"
+        # Text search needs Elastic Search
+        rag.RETRIEVAL_METHOD = "vector"
+        # The local index is not built from an Elastic Search index, so its version is not checked
+        rag.INDEX_VERSION_CHECK_INTERVAL = float("inf")
+
+    rag.REQUEST_COALESCING_ENABLED = args.coalescing
+
+    if args.postgres:
+        from postgres import init_postgres
+        init_postgres()
+
+    warm_up(background=False, elastic=args.search == "elastic")
+
+    questions = pd.read_csv(args.data)["question"].tolist()
+
+    stages = {}
+    errors = []
+    lock = threading.Lock()
+
+    def record(request_stages, error):
+        with lock:
+            if error is not None:
+                errors.append(repr(error))
+                return
+            for stage, duration in request_stages.items():
+                stages.setdefault(stage, []).append(duration)
+
+    print(f"Running {args.users} users x {args.requests} requests...")
+
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        for _ in range(args.users):
+            executor.submit(run_user, questions, args.requests, args, record)
+
+    duration = time.time() - start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    if args.postgres:
+        from postgres import flush_writes
+        flush_writes()
+
+    cpu_time = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+    completed = len(stages.get("total", []))
+
+    return {
+        "config": {
+            "users": args.users,
+            "requests_per_user": args.requests,
+            "search": args.search,
+            "stream": args.stream,
+            "postgres": args.postgres,
+            "semantic_cache": args.semantic_cache,
+            "coalescing": args.coalescing,
+            "relevance_mode": args.relevance_mode,
+            "llm_latency": args.llm_latency,
+            "first_token_latency": args.first_token_latency,
+            "completion_tokens": args.completion_tokens,
+            "openai_url": args.openai_url
+        },
+        "completed": completed,
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "duration_s": duration,
+        "requests_per_s": completed / duration,
+        # CPU of the whole process (including the in-process stub server), 100 = one core
+        "cpu_percent": 100 * cpu_time / duration,
+        "rss_mb": current_rss_mb(),
+        "max_rss_mb": usage_end.ru_maxrss / 1024,
+        "batch_encoder": batch_encoder.stats(),
+        "coalescing": rag.in_flight.stats(),
+        "stages": {stage: latency_summary(durations) for stage, durations in stages.items()}
+    }
+
+# This function flattens the metrics of a result for comparison
+def flat_metrics(results):
+
+    metrics = {name: results[name] for name in ("requests_per_s", "cpu_percent", "rss_mb", "max_rss_mb", "errors")}
+
+    for stage, summary in results["stages"].items():
+        metrics[f"{stage}.p50_ms"] = summary["p50_ms"]
+        metrics[f"{stage}.p99_ms"] = summary["p99_ms"]
+
+    return metrics
+
+# This function returns a table which compares the results with a baseline
+def compare_results(baseline, results):
+
+    baseline_metrics = flat_metrics(baseline)
+    metrics = flat_metrics(results)
+
+    rows = []
+    for name in metrics:
+        if name in baseline_metrics:
+            before, after = baseline_metrics[name], metrics[name]
+            rows.append({"metric": name, "baseline": before, "current": after,
+                         "change_%": 100 * (after - before) / before if before else float("nan")})
+
+    return pd.DataFrame(rows)
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Offline load test of the Assistant flow with an Open AI stub server")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stub = subparsers.add_parser("stub", help="Run the Open AI stub server")
+    stub.add_argument("--host", default="127.0.0.1")
+    stub.add_argument("--port", type=int, default=8090)
+
+    run = subparsers.add_parser("run", help="Run the load test")
+    run.add_argument("--users", type=int, default=10, help="Concurrent simulated users")
+    run.add_argument("--requests", type=int, default=20, help="Questions asked by each user")
+    run.add_argument("--think-time", type=float, default=0.0, help="Mean seconds a user waits between questions")
+    run.add_argument("--feedback-rate", type=float, default=0.5, help="Fraction of the answers which get feedback")
+    run.add_argument("--search", choices=["numpy", "elastic"], default="numpy", help="In-process search or Elastic Search at ELASTIC_URL")
+    run.add_argument("--data", default="./data/data.csv", help="Data file of the in-process index and the questions")
+    run.add_argument("--stream", action="store_true", help="Stream the answers like the Assistant page")
+    run.add_argument("--postgres", action="store_true", help="Store the dialogs and feedback in Postgres")
+    run.add_argument("--semantic-cache", action="store_true", help="Use the semantic answer cache")
+    run.add_argument("--coalescing", action="store_true", help="Coalesce identical questions asked at the same time")
+    run.add_argument("--relevance-mode", choices=["sync", "deferred"], default="sync")
+    run.add_argument("--model", default=os.getenv("OPENAI_MODEL", "gpt-4o-mini"))
+    run.add_argument("--openai-url", default=None, help="Base URL of a running stub server (default: start one in process)")
+    run.add_argument("--output", default="./data/load-test.json", help="JSON file for the results")
+    run.add_argument("--compare", default=None, help="JSON results of an earlier run to compare with")
+
+    for subparser in (stub, run):
+        subparser.add_argument("--llm-latency", type=float, default=STUB_SETTINGS["latency"], help="Seconds per answer")
+        subparser.add_argument("--first-token-latency", type=float, default=STUB_SETTINGS["first_token_latency"], help="Seconds until the first streamed token")
+        subparser.add_argument("--completion-tokens", type=int, default=STUB_SETTINGS["completion_tokens"], help="Tokens per answer")
+
+    args = parser.parse_args()
+
+    if args.command == "stub":
+        STUB_SETTINGS.update(latency=args.llm_latency, first_token_latency=args.first_token_latency, completion_tokens=args.completion_tokens)
+        server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+        print(f"Open AI stub server listening on http://{args.host}:{args.port}/v1")
+        server.serve_forever()
+        return
+
+    results = run_load_test(args)
+
+    with open(args.output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+
+    print(f"Completed {results['completed']} requests ({results['errors']} errors) in {results['duration_s']:.1f}s: "
+          f"{results['requests_per_s']:.2f} requests/s, CPU {results['cpu_percent']:.0f}%, RSS {results['rss_mb']:.0f} MB")
+    print(pd.DataFrame(results["stages"]).T.to_string(float_format=lambda x: f"{x:.1f}"))
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"Compared with {args.compare}:")
+        print(compare_results(baseline, results).to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 import streamlit as st
 from streamlit_chat import message
-from rag import rag
+from rag import rag_stream
 from postgres import insert_dialog, insert_feedback
+from relevance_worker import schedule_relevance
 import uuid
 
 def main():
@@ -35,18 +36,20 @@ def main():
             st.session_state["feedback_given"] = False
             st.session_state["user_input"] = ""
             
-            with input_con:
-                # Show spinner
-                st.spinner("Thinking...")
-
-                # Get response
-                response = rag(user_input, model='gpt-4o-mini')
+            with messages_con:
+                # Show the answer while it is generated.
+                # The response is filled in when the answer is complete.
+                response = {}
+                st.write_stream(rag_stream(user_input, response, model='gpt-4o-mini'))
             
             # Create a unique UUID
             st.session_state["uuid"] = str(uuid.uuid4())
 
             # Store dialog to database
             insert_dialog(st.session_state["uuid"], user_input, response)
+
+            # Queue the dialog for relevance judging when it is deferred
+            schedule_relevance(st.session_state["uuid"], user_input, response)
             
             st.session_state["responses"].append(("system", response["answer"]))
             st.session_state["thumbsup_disabled"] = False
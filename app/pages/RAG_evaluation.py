@@ -1,5 +1,5 @@
 import streamlit as st
-from eval import calculate_similarities
+from eval import calculate_similarities, rag_results_file
 import seaborn as sns
 import matplotlib.pyplot as plt
 from eval import generate_offline_rag_evaluation_data
@@ -12,6 +12,15 @@ load_dotenv()
 # Grafana URL
 GRAFANA_URL = os.getenv("GRAFANA_URL")
 
+# This function caches the similarities of a model until its results file changes
+@st.cache_data(show_spinner=False)
+def cached_similarities(model, modified):
+    return calculate_similarities(model=model)
+
+# This function returns the similarities of a model
+def get_similarities(model):
+    return cached_similarities(model, os.path.getmtime(rag_results_file(model)))
+
 def main():
     # Set browser tab title
     st.set_page_config(page_title="eCommerce site assistant RAG evaluation ", menu_items=None, page_icon="random")
@@ -32,10 +41,8 @@ def main():
 
     # If button is clicked
     if offline_btn_clicked:
-        with st.spinner("Generating file for gpt-3.5-turbo..."):
-            generate_offline_rag_evaluation_data(model="gpt-3.5-turbo")
-        with st.spinner("Generating file for gpt-4o-mini..."):
-            generate_offline_rag_evaluation_data(model="gpt-4o-mini")
+        with st.spinner("Generating files for gpt-3.5-turbo and gpt-4o-mini..."):
+            generate_offline_rag_evaluation_data(models=["gpt-3.5-turbo", "gpt-4o-mini"])
 
     # Show a red message to inform user that files are already generated
     st.markdown(":red[Files have already been generated.]")
@@ -52,7 +59,7 @@ def main():
             st.markdown("##### gpt-3.5-turbo")
             with st.spinner('Calculating...'):
                 # Calculate similarities
-                similarities_35, df_35 = calculate_similarities(model='gpt-3.5-turbo')
+                similarities_35, df_35 = get_similarities('gpt-3.5-turbo')
 
             # Show values
             st.write(f"Count: {similarities_35['count']}")
@@ -72,7 +79,7 @@ def main():
             st.markdown("##### gpt-4o-mini")
             with st.spinner("Calculating..."):
                 # Calculate similarities
-                similarities_4o, df_4o = calculate_similarities(model='gpt-4o-mini')
+                similarities_4o, df_4o = get_similarities('gpt-4o-mini')
 
             # Show values
             st.write(f"Count: {similarities_4o['count']}")
@@ -1,5 +1,7 @@
 import streamlit as st
-from eval import generate_ground_truth_data, evaluate_text_search_retrieval, evaluate_vector_search_retrieval
+from eval import generate_ground_truth_data, evaluate_retrieval, evaluate_index_profiles
+from es import get_index_profile
+from rag import KNN_SETTINGS
 
 def main():
 
@@ -16,6 +18,9 @@ def main():
     if "vector_search_qa_eval" not in st.session_state:
         st.session_state["vector_search_qa_eval"] = ""
 
+    if "hybrid_eval" not in st.session_state:
+        st.session_state["hybrid_eval"] = ""
+
     # Set browser tab title
     st.set_page_config(page_title="eCommerce site assistant retrieval evaluation ", menu_items=None, page_icon="random")
 
@@ -37,6 +42,9 @@ def main():
     # Show a red message to inform user that files are already generated
     st.markdown(":red[File has already been generated.]")
 
+    # Number of results evaluated for each question
+    k = st.number_input("Number of results (k)", min_value=1, max_value=20, value=2)
+
     # Text search evaluation
     st.markdown("### Text search retrieval evaluation")
 
@@ -46,7 +54,7 @@ def main():
     # If button is clicked
     if text_btn_clicked:
         with st.spinner("Calculating ..."):
-            hit_rate, mrr = evaluate_text_search_retrieval()
+            hit_rate, mrr = evaluate_retrieval(["text"], k=k)["text"]
             st.session_state["text_eval"] = f"Hit Rate: {hit_rate}, MRR: {mrr}"
             
             # Display Metrics
@@ -61,20 +69,57 @@ def main():
     # If btn_clicked
     if vector_btn_clicked:
         with st.spinner("Calculating ..."):
+            # Evaluate all vector fields of the index with the same question embeddings
+            metrics = evaluate_retrieval(get_index_profile()["fields"], k=k)
             # Question
-            hit_rate, mrr = evaluate_vector_search_retrieval("question_vector")
-            st.session_state["vector_search_q_eval"] = f"Question vector: Hit Rate: {hit_rate}, MRR: {mrr}"
+            if "question_vector" in metrics:
+                hit_rate, mrr = metrics["question_vector"]
+                st.session_state["vector_search_q_eval"] = f"Question vector: Hit Rate: {hit_rate}, MRR: {mrr}"
             # Answer
-            hit_rate, mrr = evaluate_vector_search_retrieval("answer_vector")
-            st.session_state["vector_search_a_eval"] = f"Answer vector: Hit Rate: {hit_rate}, MRR: {mrr}"
+            if "answer_vector" in metrics:
+                hit_rate, mrr = metrics["answer_vector"]
+                st.session_state["vector_search_a_eval"] = f"Answer vector: Hit Rate: {hit_rate}, MRR: {mrr}"
             # Question - Answer
-            hit_rate, mrr = evaluate_vector_search_retrieval("question_answer_vector")
-            st.session_state["vector_search_qa_eval"] = f"Question - Answer vector: Hit Rate: {hit_rate}, MRR: {mrr}"
+            if "question_answer_vector" in metrics:
+                hit_rate, mrr = metrics["question_answer_vector"]
+                st.session_state["vector_search_qa_eval"] = f"Question - Answer vector: Hit Rate: {hit_rate}, MRR: {mrr}"
             
             # Display Metrics
             st.write(st.session_state["vector_search_q_eval"])
             st.write(st.session_state["vector_search_a_eval"])
             st.write(st.session_state["vector_search_qa_eval"])
+
+    # Hybrid search evaluation
+    st.markdown("### Hybrid search retrieval evaluation")
+
+    # Click button to calculate evaluation
+    hybrid_btn_clicked = st.button("Click to evaluate hybrid search retrieval")
+
+    # If button is clicked
+    if hybrid_btn_clicked:
+        with st.spinner("Calculating ..."):
+            # Evaluate hybrid search next to the methods it combines
+            field = KNN_SETTINGS["field"]
+            metrics = evaluate_retrieval(["text", field, "hybrid"], k=k)
+            hit_rate, mrr = metrics["hybrid"]
+            st.session_state["hybrid_eval"] = f"Hybrid: Hit Rate: {hit_rate}, MRR: {mrr}"
+
+            # Display Metrics
+            st.write(f"Text: Hit Rate: {metrics['text'][0]}, MRR: {metrics['text'][1]}")
+            st.write(f"Vector ({field}): Hit Rate: {metrics[field][0]}, MRR: {metrics[field][1]}")
+            st.write(st.session_state["hybrid_eval"])
+
+    # Index profile evaluation
+    st.markdown("### Index profile evaluation")
+    st.write("Each index profile is built in a temporary index and compared with the full profile.")
+
+    # Click button to evaluate the index profiles
+    profiles_btn_clicked = st.button("Click to evaluate index profiles")
+
+    # If button is clicked
+    if profiles_btn_clicked:
+        with st.spinner("Calculating ..."):
+            st.dataframe(evaluate_index_profiles(k=k))
  
 if __name__ == "__main__":
     main()
\ No newline at end of file
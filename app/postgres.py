@@ -1,10 +1,18 @@
 import psycopg2
+import psycopg2.pool
+from psycopg2.extras import execute_values
+import atexit
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 
-# This function initializes a connection
-def init_connection():
+# This function returns the connection parameters
+def connection_params():
 
     # Load environment variables
     load_dotenv()
@@ -16,100 +24,630 @@ def init_connection():
     POSTGRES_PASSWORD=os.getenv("POSTGRES_PASSWORD")
     POSTGRES_PORT=os.getenv("POSTGRES_PORT")
 
+    return {
+        'database': POSTGRES_DB,
+        'user': POSTGRES_USER,
+        'host': POSTGRES_HOST,
+        'password': POSTGRES_PASSWORD,
+        'port': POSTGRES_PORT
+    }
+
+# This function initializes a connection
+def init_connection():
+
     # Connect to postgres
-    conn = psycopg2.connect(database = POSTGRES_DB, 
-                        user = POSTGRES_USER, 
-                        host= POSTGRES_HOST,
-                        password = POSTGRES_PASSWORD,
-                        port = POSTGRES_PORT)
+    conn = psycopg2.connect(**connection_params())
 
     # Return connection
     return conn 
 
+# Thread-safe connection pool.
+# Callers wait for a free connection when all connections are in use,
+# connections are checked before they are handed out and broken
+# connections are replaced with new ones.
+class ConnectionPool:
+
+    def __init__(self, minconn, maxconn, timeout, check_after, **params):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **params)
+        self.maxconn = maxconn
+        # Seconds to wait for a free connection
+        self.timeout = timeout
+        # Connections idle for longer than this are checked before use
+        self.check_after = check_after
+        # One slot per connection, so that callers wait instead of failing
+        self.slots = threading.BoundedSemaphore(maxconn)
+        self.last_used = {}
+        self.lock = threading.Lock()
+        # Counters
+        self.in_use = 0
+        self.checkouts = 0
+        self.reconnects = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    # This function checks if a connection can be used.
+    # Recently used connections are only checked with check=True.
+    def is_healthy(self, conn, check=False):
+
+        if conn.closed:
+            return False
+
+        # Recently used connections are assumed to be healthy
+        if not check and time.time() - self.last_used.get(id(conn), 0) < self.check_after:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    # This function returns a healthy connection from the pool.
+    # Broken connections are replaced until a healthy one is found. When every
+    # connection the pool can hold was broken, the database is unavailable.
+    def checkout(self, check=False):
+
+        for _ in range(self.maxconn + 1):
+
+            conn = self.pool.getconn()
+
+            if self.is_healthy(conn, check):
+                return conn
+
+            # Replace broken connection
+            self.last_used.pop(id(conn), None)
+            self.pool.putconn(conn, close=True)
+            with self.lock:
+                self.reconnects += 1
+
+        raise psycopg2.OperationalError(f"No healthy connection after {self.maxconn + 1} attempts")
+
+    # This function lends a connection from the pool
+    @contextmanager
+    def connection(self, check=False):
+
+        # Wait for a free connection
+        wait_start = time.time()
+        if not self.slots.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError(f"No connection available after {self.timeout} seconds")
+        wait_time = time.time() - wait_start
+
+        with self.lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        conn = None
+        broken = False
+        try:
+            conn = self.checkout(check)
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except Exception:
+            if conn is not None and not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            if conn is not None:
+                # Connections that failed are closed and replaced on next checkout
+                close = broken or bool(conn.closed)
+                if close:
+                    self.last_used.pop(id(conn), None)
+                else:
+                    self.last_used[id(conn)] = time.time()
+                self.pool.putconn(conn, close=close)
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    # This function runs fn with a cursor in one transaction and commits it.
+    # A recently used connection is handed out without a check and may have been
+    # closed by the server meanwhile. When fn fails with an OperationalError nothing
+    # was committed, so it runs once more on a checked connection.
+    def run(self, fn):
+
+        for attempt in range(2):
+
+            committing = False
+
+            try:
+                with self.connection(check=attempt > 0) as conn:
+                    with conn.cursor() as cursor:
+                        result = fn(cursor)
+                    committing = True
+                    conn.commit()
+                    return result
+            except psycopg2.OperationalError:
+                # The outcome of a failed commit is unknown, so it is not repeated
+                if committing or attempt > 0:
+                    raise
+                with self.lock:
+                    self.reconnects += 1
+
+    # This function returns the pool counters
+    def stats(self):
+        with self.lock:
+            return {
+                'max_size': self.maxconn,
+                'in_use': self.in_use,
+                'utilization': self.in_use / self.maxconn,
+                'checkouts': self.checkouts,
+                'reconnects': self.reconnects,
+                'avg_wait_time': self.total_wait_time / self.checkouts if self.checkouts else 0.0,
+                'max_wait_time': self.max_wait_time
+            }
+
+# Pool shared by all sessions and pages of the process, created on first use
+pool = None
+pool_lock = threading.Lock()
+
+# This function returns the connection pool
+def get_pool():
+    global pool
+
+    with pool_lock:
+        if pool is None:
+            pool = ConnectionPool(minconn=int(os.getenv("POSTGRES_POOL_MIN", 1)),
+                                  maxconn=int(os.getenv("POSTGRES_POOL_MAX", 10)),
+                                  timeout=float(os.getenv("POSTGRES_POOL_TIMEOUT", 30)),
+                                  check_after=float(os.getenv("POSTGRES_POOL_CHECK_AFTER", 60)),
+                                  **connection_params())
+
+    return pool
+
+# This function lends a connection from the pool
+def get_connection():
+    return get_pool().connection()
+
+# This function runs fn with a cursor in one transaction (see ConnectionPool.run)
+def run_transaction(fn):
+    return get_pool().run(fn)
+
+# This function returns the pool wait time and utilization
+def pool_stats():
+    return get_pool().stats()
+
+# Metrics rollups.
+# The dashboard reads per-minute and per-hour totals instead of scanning the
+# dialogs and feedback tables. The rollups are kept up to date by statement
+# triggers: the rows changed by a statement are summed per bucket and each
+# bucket is upserted once. Inserted rows are added, deleted rows subtracted and
+# an update (the deferred relevance) subtracts the old rows and adds the new ones.
+# Buckets are upserted in (resolution, bucket) order, so concurrent writers lock
+# them in the same order and cannot deadlock.
+ROLLUP_RESOLUTIONS = ("minute", "hour")
+
+# Rollup columns of the dialogs: (column, type, value of dialog d)
+DIALOG_ROLLUP_COLUMNS = [
+    ("dialogs", "BIGINT", "1"),
+    ("total_tokens", "BIGINT", "d.total_tokens"),
+    ("eval_total_tokens", "BIGINT", "d.eval_total_tokens"),
+    ("context_tokens", "BIGINT", "d.context_tokens"),
+    ("total_cost", "FLOAT", "d.total_cost"),
+    ("eval_total_cost", "FLOAT", "d.eval_total_cost"),
+    ("cache_hits", "BIGINT", "d.cache_hit"),
+    ("coalesced", "BIGINT", "d.coalesced"),
+    ("cost_avoided", "FLOAT", "d.cost_avoided"),
+    ("relevant", "BIGINT", "(d.relevance = 'Relevant')::int"),
+    ("partly_relevant", "BIGINT", "(d.relevance = 'Partly relevant')::int"),
+    ("non_relevant", "BIGINT", "(d.relevance = 'Non relevant')::int"),
+    # Response time histogram
+    ("response_time_sum", "FLOAT", "d.response_time"),
+    ("response_time_lt_1", "BIGINT", "(d.response_time < 1)::int"),
+    ("response_time_lt_2", "BIGINT", "(d.response_time >= 1 AND d.response_time < 2)::int"),
+    ("response_time_lt_5", "BIGINT", "(d.response_time >= 2 AND d.response_time < 5)::int"),
+    ("response_time_lt_10", "BIGINT", "(d.response_time >= 5 AND d.response_time < 10)::int"),
+    ("response_time_ge_10", "BIGINT", "(d.response_time >= 10)::int")
+]
+
+# Rollup columns of the feedback: (column, type, value of feedback d)
+FEEDBACK_ROLLUP_COLUMNS = [
+    ("thumbs_up", "BIGINT", "(d.feedback > 0)::int"),
+    ("thumbs_down", "BIGINT", "(d.feedback < 0)::int")
+]
+
+# This function returns the statement which adds the changed rows of a trigger to a rollup.
+# changes selects the changed rows with a direction column: 1 to add the row, -1 to subtract it.
+def rollup_upsert(rollup, columns, changes):
+
+    names = ", ".join(name for name, _, _ in columns)
+    resolutions = ", ".join(f"'{resolution}'" for resolution in ROLLUP_RESOLUTIONS)
+
+    return f"""INSERT INTO {rollup} AS r (resolution, bucket, {names})
+                        SELECT res, date_trunc(res, d.tstz), {", ".join(f"sum(d.direction * {value})" for _, _, value in columns)}
+                            FROM ({changes}) d CROSS JOIN unnest(ARRAY[{resolutions}]) AS res
+                            GROUP BY 1, 2
+                            ORDER BY 1, 2
+                        ON CONFLICT (resolution, bucket) DO UPDATE SET
+                            {", ".join(f"{name} = r.{name} + EXCLUDED.{name}" for name, _, _ in columns)};"""
+
+# This function returns the statements which create a rollup table of a source table,
+# add new columns to it, create the function and triggers which maintain it and
+# fill it with the existing rows
+def rollup_statements(source, rollup, columns):
+
+    names = ", ".join(name for name, _, _ in columns)
+    resolutions = ", ".join(f"'{resolution}'" for resolution in ROLLUP_RESOLUTIONS)
+
+    table = f"""CREATE TABLE IF NOT EXISTS {rollup}(
+                    resolution TEXT NOT NULL,
+                    bucket TIMESTAMPTZ NOT NULL,
+                    {", ".join(f"{name} {type} NOT NULL DEFAULT 0" for name, type, _ in columns)},
+                    PRIMARY KEY (resolution, bucket));"""
+
+    # Postgres allows transition tables only on triggers of a single event,
+    # so there is one trigger per event, all calling the same function
+    function = f"""CREATE OR REPLACE FUNCTION maintain_{rollup}() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        {rollup_upsert(rollup, columns, "SELECT n.*, 1 AS direction FROM new_rows n")}
+                    ELSIF TG_OP = 'DELETE' THEN
+                        {rollup_upsert(rollup, columns, "SELECT o.*, -1 AS direction FROM old_rows o")}
+                    ELSE
+                        {rollup_upsert(rollup, columns, "SELECT n.*, 1 AS direction FROM new_rows n UNION ALL SELECT o.*, -1 AS direction FROM old_rows o")}
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+
+                CREATE OR REPLACE TRIGGER {rollup}_insert_trigger
+                    AFTER INSERT ON {source}
+                    REFERENCING NEW TABLE AS new_rows
+                    FOR EACH STATEMENT EXECUTE FUNCTION maintain_{rollup}();
+
+                CREATE OR REPLACE TRIGGER {rollup}_update_trigger
+                    AFTER UPDATE ON {source}
+                    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                    FOR EACH STATEMENT EXECUTE FUNCTION maintain_{rollup}();
+
+                CREATE OR REPLACE TRIGGER {rollup}_delete_trigger
+                    AFTER DELETE ON {source}
+                    REFERENCING OLD TABLE AS old_rows
+                    FOR EACH STATEMENT EXECUTE FUNCTION maintain_{rollup}();"""
+
+    backfill = f"""INSERT INTO {rollup} (resolution, bucket, {names})
+                SELECT res, date_trunc(res, d.tstz), {", ".join(f"sum({value})" for _, _, value in columns)}
+                    FROM {source} d CROSS JOIN unnest(ARRAY[{resolutions}]) AS res
+                    GROUP BY 1, 2;"""
+
+    # Columns added to the rollup after it was created
+    columns = f"""ALTER TABLE {rollup}
+                    {", ".join(f"ADD COLUMN IF NOT EXISTS {name} {type} NOT NULL DEFAULT 0" for name, type, _ in columns)};"""
+
+    return table, columns, function, backfill
+
+# This function creates a rollup table with its triggers.
+# A new rollup table is filled with the existing rows. The source table is locked
+# until the transaction commits, so no row is missed or counted twice. The rollup
+# table is looked up after the lock is taken, so of concurrent initializations
+# only the first one backfills it.
+def create_rollup(cursor, source, rollup, columns):
+
+    table, alter, function, backfill = rollup_statements(source, rollup, columns)
+
+    cursor.execute(f"LOCK TABLE {source} IN SHARE ROW EXCLUSIVE MODE;")
+
+    cursor.execute("SELECT to_regclass(%s) IS NULL", (rollup,))
+    created = cursor.fetchone()[0]
+
+    cursor.execute(table)
+    cursor.execute(alter)
+    cursor.execute(function)
+
+    if created:
+        cursor.execute(backfill)
+
 # This function creates the tables if they don't exist
 def init_postgres():
 
     print("Initializing Postgres...")
 
-    # Initialize connection
-    conn = init_connection()
-    
-    # Open a cursor 
-    cursor = conn.cursor()
-      
-    # Create dialogs table
-    cursor.execute("""CREATE TABLE IF NOT EXISTS dialogs(
-                id TEXT PRIMARY KEY,
-                question TEXT NOT NULL,
-                answer TEXT NOT NULL,
-                response_time FLOAT NOT NULL,
-                prompt_tokens INT NOT NULL,
-                completion_tokens INT NOT NULL,
-                total_tokens INT NOT NULL, 
-                eval_prompt_tokens INT NOT NULL,
-                eval_completion_tokens INT NOT NULL,
-                eval_total_tokens INT NOT NULL,
-                relevance TEXT NOT NULL,
-                total_cost FLOAT NOT NULL,
-                eval_total_cost FLOAT NOT NULL,
-                tstz TIMESTAMPTZ NOT NULL);
-                """)
-    
-    # Create feedback table
-    cursor.execute("""CREATE TABLE IF NOT EXISTS feedback(
-                id SERIAL PRIMARY KEY,
-                dialog_id TEXT REFERENCES dialogs(id),
-                feedback INT NOT NULL,
-                tstz TIMESTAMPTZ NOT NULL);
-                """)
-    
-    # Commit changes
-    conn.commit()
-
-    # Close cursor and database connection
-    cursor.close()
-    conn.close()
+    # Get a connection from the pool
+    with get_connection() as conn:
+
+        # Open a cursor 
+        cursor = conn.cursor()
+
+        # Create dialogs table
+        cursor.execute("""CREATE TABLE IF NOT EXISTS dialogs(
+                    id TEXT PRIMARY KEY,
+                    question TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    response_time FLOAT NOT NULL,
+                    prompt_tokens INT NOT NULL,
+                    completion_tokens INT NOT NULL,
+                    total_tokens INT NOT NULL, 
+                    eval_prompt_tokens INT NOT NULL,
+                    eval_completion_tokens INT NOT NULL,
+                    eval_total_tokens INT NOT NULL,
+                    relevance TEXT NOT NULL,
+                    total_cost FLOAT NOT NULL,
+                    eval_total_cost FLOAT NOT NULL,
+                    tstz TIMESTAMPTZ NOT NULL,
+                    cache_hit INT NOT NULL DEFAULT 0,
+                    cost_avoided FLOAT NOT NULL DEFAULT 0,
+                    first_token_time FLOAT NOT NULL DEFAULT 0,
+                    context_tokens INT NOT NULL DEFAULT 0,
+                    context_docs INT NOT NULL DEFAULT 0,
+                    coalesced INT NOT NULL DEFAULT 0);
+                    """)
+
+        # Add columns to dialogs tables created before they existed
+        cursor.execute("""ALTER TABLE dialogs
+                    ADD COLUMN IF NOT EXISTS cache_hit INT NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS cost_avoided FLOAT NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS first_token_time FLOAT NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS context_tokens INT NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS context_docs INT NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS coalesced INT NOT NULL DEFAULT 0;
+                    """)
+
+        # Create index of the dialogs waiting for a deferred relevance judgement
+        cursor.execute("CREATE INDEX IF NOT EXISTS dialogs_pending_idx ON dialogs (tstz) WHERE relevance = 'PENDING';")
+
+        # Create feedback table
+        cursor.execute("""CREATE TABLE IF NOT EXISTS feedback(
+                    id SERIAL PRIMARY KEY,
+                    dialog_id TEXT REFERENCES dialogs(id),
+                    feedback INT NOT NULL,
+                    tstz TIMESTAMPTZ NOT NULL);
+                    """)
+
+        # Create timings table with the duration of each stage of a request
+        cursor.execute("""CREATE TABLE IF NOT EXISTS timings(
+                    id SERIAL PRIMARY KEY,
+                    dialog_id TEXT REFERENCES dialogs(id),
+                    stage TEXT NOT NULL,
+                    duration FLOAT NOT NULL,
+                    tstz TIMESTAMPTZ NOT NULL);
+                    """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS timings_tstz_idx ON timings (tstz);")
+
+        # Create indexes of the dashboard queries and the feedback lookups
+        cursor.execute("CREATE INDEX IF NOT EXISTS dialogs_tstz_idx ON dialogs (tstz);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS feedback_tstz_idx ON feedback (tstz);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS feedback_dialog_id_idx ON feedback (dialog_id);")
+
+        # Create the metrics rollups
+        create_rollup(cursor, "dialogs", "dialog_rollups", DIALOG_ROLLUP_COLUMNS)
+        create_rollup(cursor, "feedback", "feedback_rollups", FEEDBACK_ROLLUP_COLUMNS)
+
+        # Commit changes
+        conn.commit()
+
+        # Close cursor
+        cursor.close()
 
     print("DONE.")
 
+# Insert and update statements
+FEEDBACK_SQL = "insert into feedback (dialog_id, feedback, tstz) values %s"
+DIALOG_SQL = "insert into dialogs (id, question, answer, response_time, prompt_tokens, completion_tokens, total_tokens, eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, relevance, total_cost, eval_total_cost, cache_hit, cost_avoided, first_token_time, context_tokens, context_docs, coalesced, tstz) values %s"
+TIMING_SQL = "insert into timings (dialog_id, stage, duration, tstz) values %s"
+RELEVANCE_SQL = "update dialogs set relevance = %s, eval_prompt_tokens = %s, eval_completion_tokens = %s, eval_total_tokens = %s, eval_total_cost = %s where id = %s"
+
+# This function creates a feedback table row
+def feedback_row(dialog_id, feedback):
+    return (dialog_id, feedback, datetime.now(timezone.utc))
+
+# This function creates a dialogs table row
+def dialog_row(id, question, answer):
+    return (id, question, answer["answer"], answer["response_time"], answer["prompt_tokens"], answer["completion_tokens"],  answer["total_tokens"], answer["eval_prompt_tokens"], answer["eval_completion_tokens"],  answer["eval_total_tokens"], answer["relevance"], answer["total_cost"], answer["eval_total_cost"], answer.get("cache_hit", 0), answer.get("cost_avoided", 0.0), answer.get("first_token_time", answer["response_time"]), answer.get("context_tokens", 0), answer.get("context_docs", 0), answer.get("coalesced", 0), datetime.now(timezone.utc))
+
+# This function creates the parameters of a relevance update
+def relevance_row(row):
+    return (row["relevance"], row["eval_prompt_tokens"], row["eval_completion_tokens"], row["eval_total_tokens"], row["eval_total_cost"], row["id"])
+
+# This function creates the timings table rows of the spans of a request
+def timing_rows(dialog_id, spans):
+    return [(dialog_id, span["stage"], span["duration"], datetime.fromtimestamp(span["start"], timezone.utc)) for span in spans]
+
+# This function writes rows with one multi-row statement per table.
+# Dialogs are written before feedback, relevance updates and timings so that
+# a feedback row is never written before its dialog.
+def write_rows(dialogs=(), feedback=(), relevance=(), timings=()):
+
+    # Insert and update records
+    def write(cursor):
+        if dialogs:
+            execute_values(cursor, DIALOG_SQL, dialogs)
+        if feedback:
+            execute_values(cursor, FEEDBACK_SQL, feedback)
+        if relevance:
+            cursor.executemany(RELEVANCE_SQL, relevance)
+        if timings:
+            execute_values(cursor, TIMING_SQL, timings)
+
+    # Write and commit the records in one transaction
+    run_transaction(write)
+
+# Write-behind writer.
+# Rows are queued and written by a background thread in batches,
+# when the batch is full or the flush interval has passed.
+# The queue is bounded, so callers wait when the database cannot keep up.
+class WriteBehindWriter:
+
+    def __init__(self, batch_size, flush_interval, max_queue_size, retries):
+        # Maximum number of rows written at once
+        self.batch_size = batch_size
+        # Maximum seconds a row waits in the queue
+        self.flush_interval = flush_interval
+        # Attempts to write a batch before rows are written one by one
+        self.retries = retries
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        # Ids of the queued dialogs which are not written yet
+        self.pending_dialogs = set()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="postgres-write-behind", daemon=True)
+        self.thread.start()
+
+    # This function queues a row. Kind is "dialogs", "feedback", "relevance" or "timings".
+    def put(self, kind, row):
+        if kind == "dialogs":
+            with self.lock:
+                self.pending_dialogs.add(row[0])
+        self.queue.put((kind, row))
+
+    # This function checks if a dialog is queued and not written yet
+    def is_pending(self, dialog_id):
+        with self.lock:
+            return dialog_id in self.pending_dialogs
+
+    # This function waits until all queued rows are written
+    def flush(self):
+        self.queue.join()
+
+    # This function collects the next batch of rows
+    def next_batch(self):
+
+        # Wait for the first row
+        batch = [self.queue.get()]
+        deadline = time.time() + self.flush_interval
+
+        # Collect rows until the batch is full or the flush interval has passed
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    # This function writes a batch, retrying failed attempts
+    def write(self, batch):
+
+        rows = {"dialogs": [], "feedback": [], "relevance": [], "timings": []}
+        for kind, row in batch:
+            rows[kind].append(row)
+
+        for attempt in range(self.retries):
+            try:
+                write_rows(**rows)
+                return
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                # The database is unavailable, the batch may succeed later
+                print(f"Write-behind batch failed (attempt {attempt + 1}): {e}")
+                time.sleep(2 ** attempt)
+            except Exception as e:
+                # A bad row fails every attempt, so the rows are written one by one at once
+                print(f"Write-behind batch failed: {e}")
+                break
+
+        # Write rows one by one so that one bad row does not lose the whole batch
+        for kind, row in batch:
+            try:
+                write_rows(**{kind: [row]})
+            except Exception as e:
+                print(f"Write-behind row failed: {kind} {row}: {e}")
+
+    # Writer loop
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                self.write(batch)
+            finally:
+                with self.lock:
+                    self.pending_dialogs.difference_update(row[0] for kind, row in batch if kind == "dialogs")
+                for _ in batch:
+                    self.queue.task_done()
+
+# Write mode: "sync" writes rows immediately, "write_behind" queues them
+POSTGRES_WRITE_MODE = os.getenv("POSTGRES_WRITE_MODE", "sync")
+
+# Writer shared by the whole process, created on first use
+writer = None
+writer_lock = threading.Lock()
+
+# This function returns the write-behind writer
+def get_writer():
+    global writer
+
+    with writer_lock:
+        if writer is None:
+            writer = WriteBehindWriter(batch_size=int(os.getenv("POSTGRES_WRITE_BATCH_SIZE", 100)),
+                                       flush_interval=float(os.getenv("POSTGRES_WRITE_FLUSH_INTERVAL", 1.0)),
+                                       max_queue_size=int(os.getenv("POSTGRES_WRITE_QUEUE_SIZE", 10000)),
+                                       retries=int(os.getenv("POSTGRES_WRITE_RETRIES", 3)))
+            # Write queued rows before the process exits
+            atexit.register(writer.flush)
+
+    return writer
+
+# This function waits until all queued rows are written
+def flush_writes():
+    if writer is not None:
+        writer.flush()
+
+# This function checks if a dialog exists, written or queued for writing
+def dialog_exists(dialog_id):
+
+    if writer is not None and writer.is_pending(dialog_id):
+        return True
+
+    def read(cursor):
+        cursor.execute("SELECT 1 FROM dialogs WHERE id = %s", (dialog_id,))
+        return cursor.fetchone() is not None
+
+    return run_transaction(read)
+
 # This function inserts a feedback
 def insert_feedback(dialog_id, feedback):
-    
-    # Initialize connection
-    conn = init_connection()
 
-    # Open a cursor 
-    cursor = conn.cursor()
+    if POSTGRES_WRITE_MODE == "write_behind":
+        get_writer().put("feedback", feedback_row(dialog_id, feedback))
+    else:
+        write_rows(feedback=[feedback_row(dialog_id, feedback)])
 
-    # Insert record
-    sql = f"insert into feedback (dialog_id, feedback, tstz) values (%s, %s, NOW())"
-    cursor.execute(sql, (dialog_id, feedback))
+# This function inserts a chat and the timings of its stages.
+# The insert is timed too, as one of the stages.
+def insert_dialog(id, question, answer):
 
-    # Commit record
-    conn.commit()
+    start = time.time()
 
-    # Close cursor and database connection
-    cursor.close()
-    conn.close()
+    if POSTGRES_WRITE_MODE == "write_behind":
+        get_writer().put("dialogs", dialog_row(id, question, answer))
+        spans = answer.get("spans", []) + [{'stage': "insert_dialog", 'start': start, 'duration': time.time() - start}]
+        for row in timing_rows(id, spans):
+            get_writer().put("timings", row)
+        return
 
-# This function inserts a chat
-def insert_dialog(id, question, answer):
+    # Write the dialog and its timings in one transaction.
+    # The insert is timed until the commit, which writes its timing too.
+    def write(cursor):
+        execute_values(cursor, DIALOG_SQL, [dialog_row(id, question, answer)])
+        spans = answer.get("spans", []) + [{'stage': "insert_dialog", 'start': start, 'duration': time.time() - start}]
+        execute_values(cursor, TIMING_SQL, timing_rows(id, spans))
 
-    # Initialize connection
-    conn = init_connection()
+    run_transaction(write)
 
-    # Open a cursor 
-    cursor = conn.cursor()
+# This function returns the oldest dialogs with the given relevance, eg the
+# dialogs still waiting for a deferred relevance judgement
+def dialogs_with_relevance(relevance, limit):
 
-    # Insert record
-    sql = f"insert into dialogs (id, question, answer, response_time, prompt_tokens, completion_tokens, total_tokens, eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, relevance, total_cost, eval_total_cost, tstz) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())"
+    def read(cursor):
+        cursor.execute("SELECT id, question, answer FROM dialogs WHERE relevance = %s ORDER BY tstz LIMIT %s", (relevance, limit))
+        return [{'id': id, 'question': question, 'answer': answer} for id, question, answer in cursor.fetchall()]
 
-    # Execute cursor
-    cursor.execute(sql, (id, question, answer["answer"], answer["response_time"], answer["prompt_tokens"], answer["completion_tokens"],  answer["total_tokens"], answer["eval_prompt_tokens"], answer["eval_completion_tokens"],  answer["eval_total_tokens"], answer["relevance"], answer["total_cost"], answer["eval_total_cost"]))
+    return run_transaction(read)
 
-    # Commit record
-    conn.commit()
+# This function updates the relevance of a batch of dialogs
+def update_dialogs_relevance(rows):
 
-    # Close cursor and database connection
-    cursor.close()
-    conn.close()
\ No newline at end of file
+    if POSTGRES_WRITE_MODE == "write_behind":
+        # Queued after the dialogs, so the dialogs exist when they are updated
+        for row in rows:
+            get_writer().put("relevance", relevance_row(row))
+            for timing in timing_rows(row["id"], row.get("spans", [])):
+                get_writer().put("timings", timing)
+    else:
+        write_rows(relevance=[relevance_row(row) for row in rows],
+                   timings=[timing for row in rows for timing in timing_rows(row["id"], row.get("spans", []))])
@@ -1,34 +1,82 @@
 # Import the necessary libraries
-from sentence_transformers import SentenceTransformer
-from elasticsearch import Elasticsearch
-from openai import OpenAI
 import os
 from dotenv import load_dotenv
 import time
 import json
+import threading
+import random
+from vector_index import NumpyVectorIndex
+from semantic_cache import answer_cache, SEMANTIC_CACHE_ENABLED
+from tracing import Trace
+from single_flight import SingleFlight, LeaderAborted, coalesce_key
+from resources import get_es_client, get_openai_client, get_tokenizer
+from embedding_store import encode
+from batch_encoder import batch_encoder, BATCH_ENCODER_ENABLED
+from es import load_knn_settings, get_index_profile, truncate_vectors, index_version
 
 # Load environment variables
 load_dotenv()
 
-# Load a model for encoding embeddings
-SENTENCE_TRANSFORMER_MODEL = os.getenv("SENTENCE_TRANSFORMER_MODEL")
-model = SentenceTransformer(SENTENCE_TRANSFORMER_MODEL)
+# The sentence transformer model and the Elastic Search and Open AI clients
+# are shared resources created on first use (see resources.py)
 
 # Elastic Search
-ELASTIC_URL = os.getenv("ELASTIC_URL")
-es_client = Elasticsearch(ELASTIC_URL) 
 ELASTIC_INDEX_NAME = os.getenv("ELASTIC_INDEX_NAME")
 index_name = ELASTIC_INDEX_NAME
 
-# Open AI
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
+# Retrieval backend: "elastic" for Elastic Search kNN, "numpy" for the in-process index
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "elastic")
+VECTOR_INDEX_PATH = os.getenv("VECTOR_INDEX_PATH", "./data/vector_index")
+
+# kNN search settings (field, k, num_candidates), tuned with knn_benchmark.py
+KNN_SETTINGS = load_knn_settings()
+
+# Index profile (vector fields, dimensions, quantization) of the index
+INDEX_PROFILE = get_index_profile()
+
+# Retrieval method used by rag: "vector" or "hybrid" (text and vector search combined)
+RETRIEVAL_METHOD = os.getenv("RETRIEVAL_METHOD", "vector")
+# How hybrid search combines the results: "rrf" (reciprocal rank fusion) or "weighted" (weighted score sum)
+HYBRID_FUSION = os.getenv("HYBRID_FUSION", "rrf")
+HYBRID_TEXT_WEIGHT = float(os.getenv("HYBRID_TEXT_WEIGHT", 0.2))
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", 1.0))
+# Number of results of each search which are fused
+HYBRID_WINDOW = int(os.getenv("HYBRID_WINDOW", 10))
+RRF_RANK_CONSTANT = int(os.getenv("RRF_RANK_CONSTANT", 60))
+
+# In-process vector index, loaded on first use
+vector_index = None
+vector_index_lock = threading.Lock()
+
+# Seconds between checks of the version of the index behind the alias
+INDEX_VERSION_CHECK_INTERVAL = float(os.getenv("INDEX_VERSION_CHECK_INTERVAL", 30))
+# Last seen version of the index and when it was checked
+current_index_version = None
+index_version_checked = 0.0
+index_version_lock = threading.Lock()
 
 # Open AI model
 OPENAI_MODEL = os.getenv("OPENAI_MODEL")
 
-# Create Open AI client
-ai_client = OpenAI()
+# Maximum number of tokens of the retrieved documents in the prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1000))
+# A document is truncated to fit the budget only if at least this many tokens of it fit,
+# otherwise it is dropped
+CONTEXT_MIN_DOC_TOKENS = int(os.getenv("CONTEXT_MIN_DOC_TOKENS", 50))
+
+# Relevance evaluation mode: "sync" judges every answer before rag returns,
+# "deferred" leaves the relevance as PENDING and judges it in the background
+RELEVANCE_MODE = os.getenv("RELEVANCE_MODE", "sync")
+# Fraction of the dialogs judged in deferred mode
+RELEVANCE_SAMPLE_RATE = float(os.getenv("RELEVANCE_SAMPLE_RATE", 1.0))
+
+# Identical questions asked at the same time share one pipeline run
+REQUEST_COALESCING_ENABLED = os.getenv("REQUEST_COALESCING_ENABLED", "true").lower() == "true"
+in_flight = SingleFlight()
+
+# Relevance values which are not a judgement
+PENDING_RELEVANCE = "PENDING"
+NOT_EVALUATED_RELEVANCE = "NOT_EVALUATED"
 
 # Function to calculate llm cost
 def calculate_cost(prompt_tokens, completion_tokens):
@@ -42,12 +90,23 @@ def calculate_cost(prompt_tokens, completion_tokens):
     
     return total_cost
 
-# Define text search function
-def elastic_text_search(query):
-    
-    # Create query
-    search_query = {
-        "size": 2,
+# This function encodes a query to a vector.
+# Queries of concurrent requests are encoded together by the batch encoder.
+def encode_query(query):
+
+    if BATCH_ENCODER_ENABLED:
+        return truncate_vectors(batch_encoder.encode(query), INDEX_PROFILE["dims"])
+
+    return truncate_vectors(encode(query), INDEX_PROFILE["dims"])
+
+# This function encodes a batch of queries to vectors
+def encode_queries(queries):
+    return truncate_vectors(encode(queries, batch_size=int(os.getenv("ENCODE_BATCH_SIZE", 64))), INDEX_PROFILE["dims"])
+
+# This function creates the text search request
+def text_search_body(query, size=2):
+    return {
+        "size": size,
         "query": {
             "bool": {
                 "must": {
@@ -61,8 +120,28 @@ def elastic_text_search(query):
         }
     }
 
+# This function creates the vector search request
+def vector_search_body(field, query_v, k=None, num_candidates=None):
+
+    # Use the tuned settings by default
+    k = k or KNN_SETTINGS["k"]
+    num_candidates = max(k, num_candidates or KNN_SETTINGS["num_candidates"])
+
+    return {
+        "size": k,
+        "knn": {
+            "field": field,
+            "query_vector": [float(x) for x in query_v],
+            "k": k,
+            "num_candidates": num_candidates
+        },
+        "_source": ["id", "question", "answer"]
+    }
+
+# Define text search function
+def elastic_text_search(query):
 
-    response = es_client.search(index=index_name, body=search_query)
+    response = get_es_client().search(index=index_name, body=text_search_body(query))
     
     result_docs = []
     
@@ -72,20 +151,13 @@ def elastic_text_search(query):
     return result_docs
 
 # Define vector search function
-def elastic_vector_search(field, query):
+def elastic_vector_search(field, query, query_v=None):
 
     # Encode query to a vector
-    query_v = model.encode(query)
-
-    # Construct search query
-    search_query = {
-        "field": field,
-        "query_vector": query_v,
-        "k": 2,
-        "num_candidates": 10000, 
-    }
+    if query_v is None:
+        query_v = encode_query(query)
 
-    response = es_client.search(index=index_name, knn=search_query, source=["id", "question", "answer"])
+    response = get_es_client().search(index=index_name, body=vector_search_body(field, query_v))
     
     result_docs = []
     
@@ -93,27 +165,266 @@ def elastic_vector_search(field, query):
         result_docs.append(hit['_source'])
     
     return result_docs
+
+# This function sends many search requests with _msearch, chunk_size requests per round trip.
+# It returns the result documents of each request.
+def elastic_msearch(bodies, chunk_size=100, index=None):
+
+    results = []
+
+    for start in range(0, len(bodies), chunk_size):
+
+        # Each search is a header line followed by the request body
+        searches = []
+        for body in bodies[start:start + chunk_size]:
+            searches.append({"index": index or index_name})
+            searches.append(body)
+
+        response = get_es_client().msearch(searches=searches)
+
+        for item in response['responses']:
+            if 'error' in item:
+                print(item['error'])
+            results.append([hit['_source'] for hit in item.get('hits', {}).get('hits', [])])
+
+    return results
+
+# Define text search function for a batch of queries
+def text_search_batch(queries, k=2, chunk_size=100):
+    return elastic_msearch([text_search_body(query, size=k) for query in queries], chunk_size=chunk_size)
+
+# This function returns the version of the index behind the alias (see es.index_version).
+# The version is read at most every INDEX_VERSION_CHECK_INTERVAL seconds. When it
+# changed, eg after a rebuild or a delta sync by another process, the cached answers
+# are removed. Without Elastic Search (a saved numpy index only) the version is None.
+def check_index_version():
+    global current_index_version, index_version_checked
+
+    if not os.getenv("ELASTIC_URL"):
+        return None
+
+    with index_version_lock:
+
+        if time.time() - index_version_checked < INDEX_VERSION_CHECK_INTERVAL:
+            return current_index_version
+
+        version = index_version(get_es_client(), index_name)
+        changed = current_index_version is not None and version != current_index_version
+        current_index_version = version
+        index_version_checked = time.time()
+
+    if changed:
+        # Cached answers were based on the old index
+        answer_cache.invalidate()
+
+    return version
+
+# This function drops the in-process vector index, eg when the index was synced,
+# so that it is loaded again on next use
+def reset_vector_index():
+    global vector_index, index_version_checked
+
+    with vector_index_lock:
+        vector_index = None
+
+    with index_version_lock:
+        index_version_checked = 0.0
+
+# This function returns the in-process vector index.
+# The index is loaded from disk (memory-mapped) if it has been saved before,
+# otherwise it is built from the Elastic Search index and saved.
+# It is built again when the index behind the alias changed.
+def get_vector_index():
+    global vector_index
+
+    version = check_index_version()
+
+    with vector_index_lock:
+
+        if vector_index is not None and version is not None and vector_index.version != version:
+            vector_index = None
+
+        if vector_index is None:
+            if os.path.exists(os.path.join(VECTOR_INDEX_PATH, "docs.json")):
+                vector_index = NumpyVectorIndex.load(VECTOR_INDEX_PATH)
+            if vector_index is None or (version is not None and vector_index.version != version):
+                vector_index = NumpyVectorIndex.from_elastic(get_es_client(), index_name, fields=INDEX_PROFILE["fields"], version=version)
+                vector_index.save(VECTOR_INDEX_PATH)
+
+    return vector_index
+
+# Define in-process vector search function
+def numpy_vector_search(field, query, query_v=None):
+
+    # Encode query to a vector
+    if query_v is None:
+        query_v = encode_query(query)
+
+    return get_vector_index().search(field, query_v, k=KNN_SETTINGS["k"])
+
+# Define vector search function for a batch of queries.
+# Already encoded query vectors can be passed to avoid encoding the queries again.
+def vector_search_batch(field, queries, query_vectors=None, k=2, chunk_size=100):
+
+    # Encode all queries at once
+    if query_vectors is None:
+        query_vectors = encode_queries(queries)
+
+    if RETRIEVAL_BACKEND == "numpy":
+        return get_vector_index().search_batch(field, query_vectors, k=k)
+
+    return elastic_msearch([vector_search_body(field, query_v, k=k) for query_v in query_vectors], chunk_size=chunk_size)
+
+# Define vector search function using the configured backend
+def vector_search(field, query, query_v=None):
+
+    if RETRIEVAL_BACKEND == "numpy":
+        return numpy_vector_search(field, query, query_v)
+
+    return elastic_vector_search(field, query, query_v)
     
-# Define build prompt function
-def build_prompt(query, search_results):
-    prompt_template = """
-    You're a eCommerce site chatbot. Answer the QUESTION based on the CONTEXT from our database.
-    Use only the facts from the CONTEXT when answering the QUESTION. If you don't find an answer
-    just say that you are sorry but you don't have an answer to this question.
+# This function creates the hybrid search request.
+# The text query and the kNN search are sent in one request and
+# Elastic Search adds their scores, weighted by their boosts.
+def hybrid_search_body(query, field, query_v, k=2):
 
-    QUESTION: {question}
+    body = vector_search_body(field, query_v, k=max(k, HYBRID_WINDOW))
+    body["size"] = k
+    body["knn"]["boost"] = HYBRID_VECTOR_WEIGHT
+    body["query"] = text_search_body(query)["query"]
+    body["query"]["bool"]["boost"] = HYBRID_TEXT_WEIGHT
 
-    CONTEXT:
-    {context}
-    """.strip()
+    return body
+
+# This function fuses result lists with reciprocal rank fusion.
+# Each document scores 1 / (rank constant + rank) in every list it appears in.
+def rrf_fuse(result_lists, k=2, rank_constant=RRF_RANK_CONSTANT):
+
+    scores = {}
+    docs = {}
+
+    for results in result_lists:
+        for rank, doc in enumerate(results, start=1):
+            scores[doc['id']] = scores.get(doc['id'], 0.0) + 1.0 / (rank_constant + rank)
+            docs[doc['id']] = doc
+
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+
+    return [docs[doc_id] for doc_id in best]
+
+# This function returns the requests of a hybrid search.
+# Weighted fusion needs one request, reciprocal rank fusion needs a text and a vector request
+# which are sent together with _msearch.
+def hybrid_search_bodies(query, field, query_v, k=2):
+
+    if HYBRID_FUSION == "weighted":
+        return [hybrid_search_body(query, field, query_v, k=k)]
+
+    return [text_search_body(query, size=HYBRID_WINDOW), vector_search_body(field, query_v, k=HYBRID_WINDOW)]
+
+# This function combines the results of the hybrid search requests
+def hybrid_fuse(results, k=2):
+
+    if HYBRID_FUSION == "weighted":
+        return results[0][:k]
+
+    return rrf_fuse(results, k=k)
+
+# Define hybrid search function.
+# Text and vector search are done in one round trip to Elastic Search.
+def hybrid_search(query, field="question_vector", query_v=None, k=2):
+    return hybrid_search_batch([query], field=field, query_vectors=None if query_v is None else [query_v], k=k)[0]
+
+# Define hybrid search function for a batch of queries
+def hybrid_search_batch(queries, field="question_vector", query_vectors=None, k=2, chunk_size=100):
+
+    # Encode all queries at once
+    if query_vectors is None:
+        query_vectors = encode_queries(queries)
 
-    context = ""
+    # Requests of every query
+    query_bodies = [hybrid_search_bodies(query, field, query_v, k=k) for query, query_v in zip(queries, query_vectors)]
+    requests_per_query = len(query_bodies[0]) if query_bodies else 1
+
+    # Send all requests, keeping the requests of a query in the same round trip
+    results = elastic_msearch([body for bodies in query_bodies for body in bodies],
+                              chunk_size=max(1, chunk_size // requests_per_query) * requests_per_query)
+
+    return [hybrid_fuse(results[i:i + requests_per_query], k=k) for i in range(0, len(results), requests_per_query)]
+
+# This function returns the Elastic Search requests of the configured retrieval method.
+# Used with retrieval_fuse by callers which send the requests themselves (api.py).
+def retrieval_bodies(query, query_v):
+
+    if RETRIEVAL_METHOD == "hybrid":
+        return hybrid_search_bodies(query, KNN_SETTINGS["field"], query_v, k=KNN_SETTINGS["k"])
+
+    return [vector_search_body(KNN_SETTINGS["field"], query_v)]
+
+# This function combines the results of the retrieval requests
+def retrieval_fuse(results):
+
+    if RETRIEVAL_METHOD == "hybrid":
+        return hybrid_fuse(results, k=KNN_SETTINGS["k"])
+
+    return results[0]
+
+# This function retrieves the documents used to answer a query with the configured retrieval method
+def retrieve(query, query_v=None):
+
+    if RETRIEVAL_METHOD == "hybrid":
+        return hybrid_search(query, KNN_SETTINGS["field"], query_v, k=KNN_SETTINGS["k"])
+
+    return vector_search(KNN_SETTINGS["field"], query, query_v)
+
+# Define build prompt function
+# Static instructions at the start of every prompt.
+# The variable context and question follow them, so the instructions are
+# a common prefix which the provider can cache between requests.
+PROMPT_INSTRUCTIONS = """
+You're a eCommerce site chatbot. Answer the QUESTION based on the CONTEXT from our database.
+Use only the facts from the CONTEXT when answering the QUESTION. If you don't find an answer
+just say that you are sorry but you don't have an answer to this question.
+""".strip()
+
+# This function packs the search results into the token budget.
+# Results are added in rank order. The first result which does not fit is
+# truncated when enough of it fits, and lower ranked results are dropped.
+# Returns the context, its number of tokens and the number of documents used.
+def pack_context(search_results, budget=CONTEXT_TOKEN_BUDGET, model=OPENAI_MODEL):
+
+    tokenizer = get_tokenizer(model)
+    entries = []
+    used = 0
 
     for doc in search_results:
-        context = context + f"question: {doc['question']}\nanswer: {doc['answer']}\n\n"
 
-    prompt = prompt_template.format(question=query, context=context).strip()
-    return prompt
+        entry = f"question: {doc['question']}\nanswer: {doc['answer']}"
+        tokens = tokenizer.encode(entry)
+        remaining = budget - used
+
+        if len(tokens) <= remaining:
+            entries.append(entry)
+            used += len(tokens)
+            continue
+
+        if remaining >= CONTEXT_MIN_DOC_TOKENS:
+            entries.append(tokenizer.decode(tokens[:remaining]))
+            used += remaining
+
+        break
+
+    return "\n\n".join(entries), used, len(entries)
+
+# This function builds the prompt.
+# Returns the prompt and the number of context tokens and documents in it.
+def build_prompt(query, search_results, model=OPENAI_MODEL, budget=CONTEXT_TOKEN_BUDGET):
+
+    context, context_tokens, context_docs = pack_context(search_results, budget=budget, model=model)
+
+    prompt = f"{PROMPT_INSTRUCTIONS}\n\nCONTEXT:\n{context}\n\nQUESTION: {query}"
+
+    return prompt, {'context_tokens': context_tokens, 'context_docs': context_docs}
     
 # Define llm function
 def llm(prompt, model=OPENAI_MODEL):
@@ -122,7 +433,7 @@ def llm(prompt, model=OPENAI_MODEL):
     start_time = time.time()
 
     # Get response from LLM
-    response = ai_client.chat.completions.create(
+    response = get_openai_client().chat.completions.create(
         model=model,
         messages=[{"role": "user", "content": prompt}]
     )
@@ -148,9 +459,8 @@ def llm(prompt, model=OPENAI_MODEL):
 
     return answer, tokens, response_time, cost
 
-# Define relevance function
-def get_relevance(question, answer):
-    prompt_template = """
+# Relevance prompt
+RELEVANCE_PROMPT_TEMPLATE = """
     You evaluate our RAG system. One of your tasks is to analyze if there is a relevance
     between the given question and the generated answer. You have to classify the relevance
     as "Relevant", "Non relevant" or "Partly relevant"
@@ -167,39 +477,98 @@ def get_relevance(question, answer):
     }}
     """.strip()
 
+# This function returns the relevance of a judge answer, or UNKNOWN if it can't be parsed
+def parse_relevance(eval):
+    try:
+        evaluate_json = json.loads(eval)
+        return evaluate_json["Relevance"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return "UNKNOWN"
+
+# Define relevance function
+def get_relevance(question, answer):
+
     # Create prompt
-    prompt = prompt_template.format(question=question, answer=answer)
+    prompt = RELEVANCE_PROMPT_TEMPLATE.format(question=question, answer=answer)
 
     # Get values
     eval, tokens, _, cost = llm(prompt, model=OPENAI_MODEL)
    
     # Return values
-    # Check if the answer can be parsed
-    try:
-        print(answer)
-        evaluate_json = json.loads(eval)
-        return evaluate_json["Relevance"], tokens, cost
-    except json.JSONDecodeError:
-        return "UNKNOWN", tokens
-    
-# Define rag function
-def rag(query, model=OPENAI_MODEL) -> str:
-    
-    # Get results from elastic database
-    search_results = elastic_vector_search("question_vector", query)
-    
-    # Build a prompt
-    prompt = build_prompt(query, search_results)
+    return parse_relevance(eval), tokens, cost
     
-    # Get answer from LLM
-    answer, tokens, response_time, cost = llm(prompt, model=model)
+# This function returns the response for a cache hit
+def cached_response(cached, start_time, trace):
 
-    # Get relevance from LLM
-    relevance, eval_tokens, eval_total_cost = get_relevance(query, answer)
-    
+    response_time = time.time() - start_time
+
+    return {
+        'answer': cached['answer'],
+        'response_time': response_time,
+        'first_token_time': response_time,
+        'relevance': cached['relevance'] if cached['relevance'] not in (PENDING_RELEVANCE, NOT_EVALUATED_RELEVANCE) else NOT_EVALUATED_RELEVANCE,
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+        'total_tokens': 0,
+        'eval_prompt_tokens': 0,
+        'eval_completion_tokens': 0,
+        'eval_total_tokens': 0,
+        'total_cost': 0.0,
+        'eval_total_cost': 0.0,
+        'cache_hit': 1,
+        'coalesced': 0,
+        'cost_avoided': cached['total_cost'] + cached['eval_total_cost'],
+        'context_tokens': 0,
+        'context_docs': 0,
+        'spans': trace.spans
+    }
+
+# This function returns the response of a request which waited for an identical request.
+# The answer is shared, the tokens and costs were spent by the other request.
+# When the other request was answered from the cache, the cost it avoided is avoided again.
+def coalesced_response(shared, start_time):
+
+    response_time = time.time() - start_time
+
+    response = dict(shared)
+    response.update({
+        'response_time': response_time,
+        'first_token_time': response_time,
+        'relevance': shared['relevance'] if shared['relevance'] not in (PENDING_RELEVANCE, NOT_EVALUATED_RELEVANCE) else NOT_EVALUATED_RELEVANCE,
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+        'total_tokens': 0,
+        'eval_prompt_tokens': 0,
+        'eval_completion_tokens': 0,
+        'eval_total_tokens': 0,
+        'total_cost': 0.0,
+        'eval_total_cost': 0.0,
+        'cache_hit': 0,
+        'coalesced': 1,
+        'cost_avoided': shared['total_cost'] + shared['eval_total_cost'] + shared['cost_avoided'],
+        'context_tokens': 0,
+        'context_docs': 0,
+        'spans': [{'stage': "coalesced", 'start': start_time, 'duration': response_time}]
+    })
+
+    return response
+
+# This function judges the relevance of an answer according to the relevance mode
+def judge_relevance(query, answer, relevance_mode):
+
+    if relevance_mode == "deferred":
+        # Relevance is judged later by the relevance workers for a sample of the dialogs
+        relevance = PENDING_RELEVANCE if random.random() < RELEVANCE_SAMPLE_RATE else NOT_EVALUATED_RELEVANCE
+        return relevance, {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}, 0.0
+
+    return get_relevance(query, answer)
+
+# This function creates the response of the rag functions
+def build_response(answer, tokens, response_time, first_token_time, cost, relevance, eval_tokens, eval_total_cost, context, trace):
     return {
         'answer': answer,
         'response_time': response_time,
+        'first_token_time': first_token_time,
         'relevance': relevance,
         'prompt_tokens': tokens["prompt_tokens"],
         'completion_tokens': tokens['completion_tokens'],
@@ -208,5 +577,214 @@ def rag(query, model=OPENAI_MODEL) -> str:
         'eval_completion_tokens': eval_tokens['completion_tokens'],
         'eval_total_tokens': eval_tokens['total_tokens'],
         'total_cost': cost,
-        'eval_total_cost': eval_total_cost
+        'eval_total_cost': eval_total_cost,
+        'cache_hit': 0,
+        'coalesced': 0,
+        'cost_avoided': 0.0,
+        'context_tokens': context['context_tokens'],
+        'context_docs': context['context_docs'],
+        'spans': trace.spans
+    }
+
+# Define rag function.
+# Identical questions asked while one is being answered wait for its answer.
+def rag(query, model=OPENAI_MODEL, use_cache=SEMANTIC_CACHE_ENABLED, relevance_mode=RELEVANCE_MODE) -> str:
+
+    if not REQUEST_COALESCING_ENABLED:
+        return run_rag(query, model, use_cache, relevance_mode)
+
+    # Get start time
+    start_time = time.time()
+
+    response, coalesced = in_flight.do(coalesce_key(query, model, use_cache, relevance_mode), lambda: run_rag(query, model, use_cache, relevance_mode))
+
+    return coalesced_response(response, start_time) if coalesced else response
+
+# This function answers a query: retrieval, prompt, answer and relevance
+def run_rag(query, model, use_cache, relevance_mode):
+
+    # Get start time
+    start_time = time.time()
+
+    # Time every stage of the request
+    trace = Trace()
+
+    # Encode query to a vector
+    with trace.span("encode"):
+        query_v = encode_query(query)
+
+    # Return the cached answer of a similar question if there is one
+    if use_cache:
+        with trace.span("cache_lookup"):
+            check_index_version()
+            cached = answer_cache.lookup(model, query_v)
+        if cached is not None:
+            return cached_response(cached, start_time, trace)
+
+    # Get results from elastic database
+    with trace.span("search"):
+        search_results = retrieve(query, query_v)
+    
+    # Build a prompt within the context token budget
+    with trace.span("build_prompt"):
+        prompt, context = build_prompt(query, search_results, model=model)
+    
+    # Get answer from LLM
+    with trace.span("llm"):
+        answer, tokens, response_time, cost = llm(prompt, model=model)
+
+    # Get relevance from LLM
+    with trace.span("relevance"):
+        relevance, eval_tokens, eval_total_cost = judge_relevance(query, answer, relevance_mode)
+
+    # Without streaming the first token arrives with the whole answer
+    response = build_response(answer, tokens, response_time, response_time, cost, relevance, eval_tokens, eval_total_cost, context, trace)
+
+    # Cache the answer for similar questions
+    if use_cache:
+        answer_cache.store(model, query_v, response)
+
+    return response
+
+# Define streaming llm function.
+# Yields the answer tokens as they arrive and fills the result dictionary
+# with the answer, tokens, response time, time to first token and cost when the stream ends.
+def llm_stream(prompt, result, model=OPENAI_MODEL):
+
+    # Get start time
+    start_time = time.time()
+    first_token_time = None
+
+    # Get response stream from LLM. The last chunk contains the token usage.
+    stream = get_openai_client().chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+
+    parts = []
+    usage = None
+
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            # Time to first token
+            if first_token_time is None:
+                first_token_time = time.time() - start_time
+            parts.append(chunk.choices[0].delta.content)
+            yield chunk.choices[0].delta.content
+        if chunk.usage is not None:
+            usage = chunk.usage
+
+    # Calculate response time
+    response_time = time.time() - start_time
+
+    # LLM tokens
+    tokens = {
+        'prompt_tokens': usage.prompt_tokens if usage else 0,
+        'completion_tokens': usage.completion_tokens if usage else 0,
+        'total_tokens': usage.total_tokens if usage else 0
     }
+
+    result.update({
+        'answer': "".join(parts),
+        'tokens': tokens,
+        'response_time': response_time,
+        'first_token_time': first_token_time if first_token_time is not None else response_time,
+        'cost': calculate_cost(tokens['prompt_tokens'], tokens['completion_tokens'])
+    })
+
+# Define streaming rag function.
+# Yields the answer tokens as they arrive. When the stream ends the response
+# dictionary is filled with the same values that rag returns.
+# Identical questions asked while one is being answered wait for its answer
+# and get it in one piece. If that stream is stopped before the answer is
+# complete, the waiting questions are answered again by one of them.
+def rag_stream(query, response, model=OPENAI_MODEL, use_cache=SEMANTIC_CACHE_ENABLED, relevance_mode=RELEVANCE_MODE):
+
+    if not REQUEST_COALESCING_ENABLED:
+        yield from run_rag_stream(query, response, model, use_cache, relevance_mode)
+        return
+
+    # Get start time
+    start_time = time.time()
+
+    key = coalesce_key(query, model, use_cache, relevance_mode)
+
+    while True:
+
+        future, leader = in_flight.begin(key)
+
+        if leader:
+            break
+
+        try:
+            shared = future.result()
+        except LeaderAborted:
+            # The answering stream was stopped, join or lead the next attempt
+            continue
+
+        response.update(coalesced_response(shared, start_time))
+        yield response['answer']
+        return
+
+    try:
+        yield from run_rag_stream(query, response, model, use_cache, relevance_mode)
+    except GeneratorExit:
+        # The stream was closed before the answer was complete
+        in_flight.fail(key, LeaderAborted("The identical request was stopped before it was answered"))
+        raise
+    except BaseException as e:
+        in_flight.fail(key, e)
+        raise
+
+    in_flight.finish(key, dict(response))
+
+# This function streams the answer of a query: retrieval, prompt, answer and relevance
+def run_rag_stream(query, response, model, use_cache, relevance_mode):
+
+    # Get start time
+    start_time = time.time()
+
+    # Time every stage of the request
+    trace = Trace()
+
+    # Encode query to a vector
+    with trace.span("encode"):
+        query_v = encode_query(query)
+
+    # Return the cached answer of a similar question if there is one
+    if use_cache:
+        with trace.span("cache_lookup"):
+            check_index_version()
+            cached = answer_cache.lookup(model, query_v)
+        if cached is not None:
+            response.update(cached_response(cached, start_time, trace))
+            yield response['answer']
+            return
+
+    # Get results from elastic database
+    with trace.span("search"):
+        search_results = retrieve(query, query_v)
+
+    # Build a prompt within the context token budget
+    with trace.span("build_prompt"):
+        prompt, context = build_prompt(query, search_results, model=model)
+
+    # Stream answer from LLM.
+    # The stage is timed by llm_stream, so the time the caller spends
+    # between tokens is part of it the same way as in the response time.
+    result = {}
+    llm_start = time.time()
+    yield from llm_stream(prompt, result, model=model)
+    trace.add("llm", llm_start, result['response_time'])
+
+    # Get relevance from LLM
+    with trace.span("relevance"):
+        relevance, eval_tokens, eval_total_cost = judge_relevance(query, result['answer'], relevance_mode)
+
+    response.update(build_response(result['answer'], result['tokens'], result['response_time'], result['first_token_time'], result['cost'], relevance, eval_tokens, eval_total_cost, context, trace))
+
+    # Cache the answer for similar questions
+    if use_cache:
+        answer_cache.store(model, query_v, dict(response))
@@ -0,0 +1,149 @@
+import os
+import queue
+import threading
+import time
+from dotenv import load_dotenv
+from rag import get_relevance, PENDING_RELEVANCE
+from postgres import update_dialogs_relevance, dialogs_with_relevance
+from tracing import Trace
+
+# Load environment variables
+load_dotenv()
+
+# Number of background workers
+RELEVANCE_WORKERS = int(os.getenv("RELEVANCE_WORKERS", 2))
+# Maximum number of dialogs judged by a worker before the database is updated
+RELEVANCE_BATCH_SIZE = int(os.getenv("RELEVANCE_BATCH_SIZE", 10))
+# Maximum number of dialogs waiting in memory
+RELEVANCE_QUEUE_SIZE = int(os.getenv("RELEVANCE_QUEUE_SIZE", 1000))
+# Seconds between sweeps for pending dialogs which are not queued
+RELEVANCE_SWEEP_INTERVAL = float(os.getenv("RELEVANCE_SWEEP_INTERVAL", 300))
+
+# Dialogs waiting to be judged.
+# The queue only lives in memory: dialogs which were not judged before the
+# process stopped, or did not fit in the queue, stay PENDING in the database
+# and are queued again by the sweeper.
+relevance_queue = queue.Queue(maxsize=RELEVANCE_QUEUE_SIZE)
+# Ids of the queued dialogs
+queued_ids = set()
+queued_ids_lock = threading.Lock()
+
+# Workers are started on first use
+workers = []
+workers_lock = threading.Lock()
+
+# This function queues a stored dialog for relevance judging.
+# Dialogs which were not sampled are ignored.
+def schedule_relevance(dialog_id, question, response):
+
+    if response["relevance"] != PENDING_RELEVANCE:
+        return False
+
+    start_workers()
+
+    return enqueue({'id': dialog_id, 'question': question, 'answer': response["answer"]})
+
+# This function queues a dialog unless it is already queued.
+# When the queue is full the dialog is left to the sweeper, so requests never wait.
+def enqueue(item):
+
+    with queued_ids_lock:
+        if item['id'] in queued_ids:
+            return False
+        queued_ids.add(item['id'])
+
+    try:
+        relevance_queue.put_nowait(item)
+    except queue.Full:
+        with queued_ids_lock:
+            queued_ids.discard(item['id'])
+        return False
+
+    return True
+
+# This function starts the worker threads and the sweeper
+def start_workers():
+    with workers_lock:
+        if not workers:
+            for i in range(RELEVANCE_WORKERS):
+                worker = threading.Thread(target=run_worker, name=f"relevance-worker-{i}", daemon=True)
+                worker.start()
+                workers.append(worker)
+            sweeper = threading.Thread(target=run_sweeper, name="relevance-sweeper", daemon=True)
+            sweeper.start()
+            workers.append(sweeper)
+
+# This function queues the pending dialogs of the database which are not queued,
+# eg the dialogs left when the process stopped. Returns the number of queued dialogs.
+def sweep_pending():
+
+    space = RELEVANCE_QUEUE_SIZE - relevance_queue.qsize()
+    if space <= 0:
+        return 0
+
+    # Queued dialogs are pending too, so the oldest dialogs beyond them are read
+    with queued_ids_lock:
+        limit = space + len(queued_ids)
+
+    return sum(enqueue(item) for item in dialogs_with_relevance(PENDING_RELEVANCE, limit))
+
+# Sweeper loop: queue the pending dialogs when the process starts and then periodically
+def run_sweeper():
+    while True:
+        try:
+            queued = sweep_pending()
+            if queued:
+                print(f"Queued {queued} pending dialogs for relevance judging")
+        except Exception as e:
+            print(f"Relevance sweep failed: {e}")
+        time.sleep(RELEVANCE_SWEEP_INTERVAL)
+
+# This function takes the next batch of dialogs from the queue.
+# It waits for the first dialog and then takes whatever else is already queued.
+def next_batch():
+
+    batch = [relevance_queue.get()]
+
+    while len(batch) < RELEVANCE_BATCH_SIZE:
+        try:
+            batch.append(relevance_queue.get_nowait())
+        except queue.Empty:
+            break
+
+    return batch
+
+# This function judges a single dialog
+def judge(item):
+
+    trace = Trace()
+
+    try:
+        with trace.span("relevance"):
+            relevance, tokens, cost = get_relevance(item['question'], item['answer'])
+    except Exception as e:
+        print(f"Relevance evaluation failed for dialog {item['id']}: {e}")
+        relevance, tokens, cost = "UNKNOWN", {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}, 0.0
+
+    return {
+        'id': item['id'],
+        'relevance': relevance,
+        'eval_prompt_tokens': tokens['prompt_tokens'],
+        'eval_completion_tokens': tokens['completion_tokens'],
+        'eval_total_tokens': tokens['total_tokens'],
+        'eval_total_cost': cost,
+        'spans': trace.spans
+    }
+
+# Worker loop: judge a batch of dialogs and update them with one database round trip
+def run_worker():
+    while True:
+        batch = next_batch()
+        try:
+            update_dialogs_relevance([judge(item) for item in batch])
+        except Exception as e:
+            print(f"Relevance update failed: {e}")
+        finally:
+            with queued_ids_lock:
+                queued_ids.difference_update(item['id'] for item in batch)
+            for _ in batch:
+                relevance_queue.task_done()
@@ -0,0 +1,109 @@
+import os
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Shared resources.
+# The sentence transformer model and the Elastic Search and Open AI clients
+# are created once per process on first use and shared by all modules and pages.
+resources = {}
+# One lock per resource, so that loading the model does not block the clients.
+# Locks of other resources (tokenizers) are added on first use.
+resource_locks = {
+    "encoder": threading.Lock(),
+    "es_client": threading.Lock(),
+    "openai_client": threading.Lock()
+}
+
+# This function returns a shared resource, creating it on first use
+def get_resource(name, create):
+
+    # Fast path when the resource already exists
+    if name in resources:
+        return resources[name]
+
+    with resource_locks.setdefault(name, threading.Lock()):
+        if name not in resources:
+            resources[name] = create()
+
+    return resources[name]
+
+# This function returns the shared sentence transformer model
+def get_encoder():
+
+    def create():
+        from encoder_backend import load_encoder
+        print("Loading model...")
+        return load_encoder()
+
+    return get_resource("encoder", create)
+
+# This function returns the shared Elastic Search client
+def get_es_client():
+
+    def create():
+        from elasticsearch import Elasticsearch
+        return Elasticsearch(os.getenv("ELASTIC_URL"))
+
+    return get_resource("es_client", create)
+
+# This function returns the shared Open AI client
+def get_openai_client():
+
+    def create():
+        from openai import OpenAI
+        return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+    return get_resource("openai_client", create)
+
+# Tokenizer used when the tiktoken encoding can't be loaded, eg on an offline
+# machine where tiktoken can't download it. A token is approximated by four characters.
+class ApproximateTokenizer:
+
+    chars_per_token = 4
+
+    def encode(self, text):
+        return [text[i:i + self.chars_per_token] for i in range(0, len(text), self.chars_per_token)]
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+# This function returns the tiktoken tokenizer of an Open AI model.
+# Models unknown to tiktoken use the cl100k_base encoding.
+def get_tokenizer(model=None):
+
+    model = model or os.getenv("OPENAI_MODEL")
+
+    def create():
+        import tiktoken
+        try:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                return tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"The tiktoken encoding could not be loaded, token counts are approximated: {e}")
+            return ApproximateTokenizer()
+
+    return get_resource(f"tokenizer:{model}", create)
+
+# This function loads the model and creates the clients ahead of the first query.
+# With background=True it returns immediately and loads them in a thread.
+# With elastic=False the Elastic Search client is not created, eg for in-process search.
+def warm_up(background=True, elastic=True):
+
+    def load():
+        get_encoder().encode("warm up")
+        if elastic:
+            get_es_client()
+        get_openai_client()
+        get_tokenizer()
+
+    if background:
+        thread = threading.Thread(target=load, name="warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    load()
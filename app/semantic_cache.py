@@ -0,0 +1,151 @@
+import numpy as np
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+# Semantic answer cache.
+# Answers are stored together with the embedding of the question that produced them.
+# A new question whose embedding is similar enough to a cached question
+# gets the cached answer instead of new LLM calls.
+# The embeddings are kept in one preallocated matrix with a row per cached answer,
+# so a lookup is one matrix - vector product, computed outside the lock.
+class SemanticCache:
+
+    def __init__(self, max_size=1000, ttl=3600, threshold=0.92):
+        # Maximum number of cached answers
+        self.max_size = max_size
+        # Seconds after which a cached answer expires
+        self.ttl = ttl
+        # Minimum cosine similarity for a cache hit
+        self.threshold = threshold
+        # Cached entries in least recently used order
+        self.entries = OrderedDict()
+        self.next_key = 0
+        self.lock = threading.Lock()
+        # Unit length question embeddings, allocated on first store
+        self.matrix = None
+        # Model code (-1 for a free row), creation time and entry key of every row
+        self.row_models = np.full(max_size, -1, dtype=np.int32)
+        self.row_created = np.zeros(max_size)
+        self.row_keys = [None] * max_size
+        # Rows freed by evictions, and the number of rows used so far
+        self.free_rows = []
+        self.rows_used = 0
+        # model -> model code
+        self.model_codes = {}
+        # Counters
+        self.hits = 0
+        self.misses = 0
+
+    # This function returns the cached response for the most similar question or None
+    def lookup(self, model, query_vector):
+
+        query_vector = unit_vector(query_vector)
+
+        with self.lock:
+            code = self.model_codes.get(model, -1)
+            matrix = self.matrix
+            used = self.rows_used
+            # Rows of the model which have not expired
+            valid = self.row_models[:used] == code
+            if self.ttl:
+                valid &= self.row_created[:used] >= time.time() - self.ttl
+
+        if code >= 0 and valid.any() and matrix.shape[1] == query_vector.shape[0]:
+
+            scores = np.where(valid, matrix[:used] @ query_vector, -np.inf)
+            best = int(np.argmax(scores))
+
+            if scores[best] >= self.threshold:
+                with self.lock:
+                    # The row may have been replaced by a store meanwhile, so it is checked again
+                    if self.row_models[best] == code and float(self.matrix[best] @ query_vector) >= self.threshold:
+                        # Mark entry as recently used
+                        key = self.row_keys[best]
+                        self.entries.move_to_end(key)
+                        self.hits += 1
+                        return self.entries[key]['response']
+
+        with self.lock:
+            self.misses += 1
+
+        return None
+
+    # This function adds a response to the cache
+    def store(self, model, query_vector, response):
+
+        query_vector = unit_vector(query_vector)
+
+        with self.lock:
+
+            # The matrix is allocated for the embedding size of the first question
+            if self.matrix is None or self.matrix.shape[1] != query_vector.shape[0]:
+                self.clear()
+                self.matrix = np.zeros((self.max_size, query_vector.shape[0]), dtype=np.float32)
+
+            # Evict the least recently used entry when the cache is full
+            if len(self.entries) >= self.max_size:
+                _, entry = self.entries.popitem(last=False)
+                self.release_row(entry['row'])
+
+            if self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                row = self.rows_used
+                self.rows_used += 1
+
+            key = self.next_key
+            self.next_key += 1
+
+            self.matrix[row] = query_vector
+            self.row_models[row] = self.model_codes.setdefault(model, len(self.model_codes))
+            self.row_created[row] = time.time()
+            self.row_keys[row] = key
+            self.entries[key] = {'model': model, 'row': row, 'response': response}
+
+    # This function frees the row of an entry. Must be called with the lock held.
+    def release_row(self, row):
+        self.row_models[row] = -1
+        self.row_keys[row] = None
+        self.free_rows.append(row)
+
+    # This function removes all cached answers, eg when the index is rebuilt
+    def invalidate(self):
+        with self.lock:
+            self.clear()
+
+    # This function removes all entries. Must be called with the lock held.
+    def clear(self):
+        self.entries.clear()
+        self.row_models[:] = -1
+        self.row_keys = [None] * self.max_size
+        self.free_rows = []
+        self.rows_used = 0
+
+    # This function returns the cache counters
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries)
+            }
+
+# This function normalizes a vector to unit length
+def unit_vector(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+# Load environment variables
+load_dotenv()
+
+# Cache settings
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+
+# Cache shared by all sessions of the process
+answer_cache = SemanticCache(max_size=int(os.getenv("SEMANTIC_CACHE_MAX_SIZE", 1000)),
+                             ttl=float(os.getenv("SEMANTIC_CACHE_TTL", 3600)),
+                             threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92)))
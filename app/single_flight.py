@@ -0,0 +1,136 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+# Error handed to the followers when the leader stopped before it had a result,
+# for example a stream closed by its client. The followers then run the call again.
+class LeaderAborted(RuntimeError):
+    pass
+
+# Request coalescing.
+# The first request for a key (the leader) runs the pipeline. Identical requests
+# which arrive while it runs (the followers) wait for its result instead of
+# running the pipeline again.
+class SingleFlight:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> future of the leader's result
+        self.calls = {}
+        # Counters
+        self.leaders = 0
+        self.coalesced = 0
+
+    # This function joins the call of a key.
+    # Returns the future of the result and whether the caller is the leader,
+    # which must then call finish or fail.
+    def begin(self, key):
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = Future()
+            self.calls[key] = future
+            self.leaders += 1
+            return future, True
+
+    # This function hands the leader's result to the followers
+    def finish(self, key, result):
+        with self.lock:
+            future = self.calls.pop(key)
+        future.set_result(result)
+
+    # This function hands the leader's error to the followers
+    def fail(self, key, error):
+        with self.lock:
+            future = self.calls.pop(key)
+        future.set_exception(error)
+
+    # This function runs fn once for all concurrent callers of a key.
+    # Returns the result and whether it was coalesced.
+    def do(self, key, fn):
+
+        future, leader = self.begin(key)
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            self.fail(key, e)
+            raise
+
+        self.finish(key, result)
+
+        return result, False
+
+    # This function returns the coalescing counters
+    def stats(self):
+        with self.lock:
+            return {
+                'leaders': self.leaders,
+                'coalesced': self.coalesced,
+                'in_flight': len(self.calls)
+            }
+
+# Request coalescing of coroutines in one event loop
+class AsyncSingleFlight:
+
+    def __init__(self):
+        # key -> task of the leader
+        self.calls = {}
+        # task -> number of callers awaiting it
+        self.waiters = {}
+        # Counters
+        self.leaders = 0
+        self.coalesced = 0
+
+    # This function awaits the coroutine of the first caller of a key for all
+    # concurrent callers. Returns the result and whether it was coalesced.
+    # The coroutine of a follower is closed without running. The task is
+    # cancelled when no caller awaits it any more, eg after their timeouts,
+    # so it never runs longer than the requests it answers.
+    async def do(self, key, coroutine):
+
+        task = self.calls.get(key)
+
+        if task is not None:
+            coroutine.close()
+            self.coalesced += 1
+            coalesced = True
+        else:
+            task = asyncio.ensure_future(coroutine)
+            self.calls[key] = task
+            self.leaders += 1
+            task.add_done_callback(lambda _: self.calls.pop(key, None) if self.calls.get(key) is task else None)
+            coalesced = False
+
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+
+        try:
+            # A cancelled caller must not cancel the task of the others
+            return await asyncio.shield(task), coalesced
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+                if not task.done():
+                    task.cancel()
+                    # New callers start a new task
+                    if self.calls.get(key) is task:
+                        del self.calls[key]
+
+    # This function returns the coalescing counters
+    def stats(self):
+        return {
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+            'in_flight': len(self.calls)
+        }
+
+# This function returns the coalescing key of a question: the question in lower
+# case with its whitespace collapsed, and the options which change its answer
+def coalesce_key(question, model, use_cache, relevance_mode):
+    return (" ".join(question.lower().split()), model, use_cache, relevance_mode)
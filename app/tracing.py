@@ -0,0 +1,23 @@
+import time
+from contextlib import contextmanager
+
+# Per-request latency tracing.
+# A trace collects the spans of one request: the stage, its start time and its duration.
+# The spans are stored in the timings table with the dialog (see postgres.py).
+class Trace:
+
+    def __init__(self):
+        self.spans = []
+
+    # This function times the code of a with block as a stage
+    @contextmanager
+    def span(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, start, time.time() - start)
+
+    # This function adds a stage which was timed elsewhere
+    def add(self, stage, start, duration):
+        self.spans.append({'stage': stage, 'start': start, 'duration': duration})
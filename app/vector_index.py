@@ -0,0 +1,109 @@
+import numpy as np
+import json
+import os
+import shutil
+from elasticsearch.helpers import scan
+
+# Vector fields kept in memory
+VECTOR_FIELDS = ["question_vector", "answer_vector", "question_answer_vector"]
+
+# In-process vector index.
+# All vectors of a field are kept in one contiguous float32 matrix so that
+# a top-k search is a single matrix - vector (or matrix - matrix) product.
+class NumpyVectorIndex:
+
+    def __init__(self, docs, vectors, version=None):
+        # Documents returned by the search (id, question, answer)
+        self.docs = docs
+        # Normalized float32 matrices, one per vector field
+        self.vectors = vectors
+        # Version of the Elastic Search index the vectors were read from (see es.index_version)
+        self.version = version
+
+    # This function builds the index from the documents stored in Elastic Search
+    @classmethod
+    def from_elastic(cls, es_client, index_name, fields=VECTOR_FIELDS, version=None):
+
+        docs = []
+        rows = {field: [] for field in fields}
+
+        # Read all documents from the index
+        for hit in scan(es_client, index=index_name, _source=["id", "question", "answer"] + list(fields)):
+            source = hit["_source"]
+            docs.append({"id": source["id"], "question": source["question"], "answer": source["answer"]})
+            for field in fields:
+                rows[field].append(source[field])
+
+        vectors = {field: normalize(np.asarray(rows[field], dtype=np.float32)) for field in fields}
+
+        return cls(docs, vectors, version)
+
+    # This function loads an index saved with save().
+    # With mmap the vector files are memory-mapped instead of read into memory.
+    @classmethod
+    def load(cls, path, mmap=True):
+
+        with open(os.path.join(path, "docs.json"), "r") as docs_file:
+            docs = json.load(docs_file)
+
+        vectors = {}
+        for file_name in os.listdir(path):
+            if file_name.endswith(".npy"):
+                field = file_name[:-len(".npy")]
+                vectors[field] = np.load(os.path.join(path, file_name), mmap_mode="r" if mmap else None)
+
+        version = None
+        if os.path.exists(os.path.join(path, "version.json")):
+            with open(os.path.join(path, "version.json"), "r") as version_file:
+                version = json.load(version_file)
+
+        return cls(docs, vectors, version)
+
+    # This function saves the index to a folder
+    def save(self, path):
+
+        os.makedirs(path, exist_ok=True)
+
+        with open(os.path.join(path, "docs.json"), "w") as docs_file:
+            json.dump(self.docs, docs_file)
+
+        for field, matrix in self.vectors.items():
+            np.save(os.path.join(path, field + ".npy"), matrix)
+
+        with open(os.path.join(path, "version.json"), "w") as version_file:
+            json.dump(self.version, version_file)
+
+    # This function returns the top k documents for a single query vector
+    def search(self, field, query_vector, k=2):
+        return self.search_batch(field, [query_vector], k=k)[0]
+
+    # This function returns the top k documents for each of the query vectors
+    def search_batch(self, field, query_vectors, k=2):
+
+        matrix = self.vectors[field]
+        queries = normalize(np.asarray(query_vectors, dtype=np.float32).reshape(-1, matrix.shape[1]))
+
+        # Cosine similarity of every query with every document
+        scores = queries @ matrix.T
+
+        # Select the k best documents without sorting all scores
+        k = min(k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+        # Sort the k best documents by score
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+
+        return [[self.docs[i] for i in row] for row in top]
+
+# This function normalizes vectors to unit length so that dot product equals cosine similarity
+def normalize(vectors):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+# This function deletes a saved index so that it is rebuilt on next use
+def delete_saved_index(path):
+    shutil.rmtree(path, ignore_errors=True)